@@ -1,26 +1,54 @@
 #!/usr/bin/env python
 
 import logging
+from datetime import datetime
 
 from google.appengine.api import memcache
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
-from lib import BaseRequest, get_cache
+from lib import BaseRequest, cached, cache_stats, LOCAL_CACHE
 import settings
+from models import Project, Issue, ProjectDeletion, ORPHAN_REFERENCES, sweep_orphans
+from models import stalled_deletions
+from tasks import queue_project_deletion, queue_orphan_sweep, queue_index
+from fulltext import reindex, index_lag, stale_pending
+
+webapp.template.register_template_library('filters')
 
 class Index(BaseRequest):
     def get(self):
         stats = memcache.get_stats()
         context = {
             'stats': stats,
+            'tiers': cache_stats(),
+            'local_items': len(LOCAL_CACHE),
+            'local_bytes': LOCAL_CACHE.bytes,
+            # set when an issue count repair has more projects to do
+            'repair': self.request.get("repair"),
+            # set when there may be more projects to migrate
+            'migrate': self.request.get("migrate"),
+            # set when an issue backfill has more issues to do
+            'backfill': self.request.get("backfill"),
+            # projects whose issues are being removed in the background
+            'deletions': ProjectDeletion.all().order('-created_date').fetch(10),
+            # set when the orphan sweeper has been started
+            'sweep': self.request.get("sweep"),
         }        
+        # how far search indexing is behind the issues saved
+        pending, oldest = index_lag()
+        context['index_pending'] = pending
+        if oldest:
+            lag = datetime.now() - oldest
+            context['index_lag'] = lag.days * 86400 + lag.seconds
         output = self.render("admin.html", context)
         self.response.out.write(output)
         
 class ClearCache(BaseRequest):
     def post(self):
         clear = memcache.flush_all()    
+        LOCAL_CACHE.clear()
         if clear:
             logging.info("Cache cleared")
         else:
@@ -28,13 +56,121 @@ class ClearCache(BaseRequest):
 
         self.redirect("/admin/")
         
+class RepairCounts(BaseRequest):
+    "Count the open and closed issues for each project again, in batches"
+    def post(self):
+        query = Project.all().order('__key__')
+        start = self.request.get("start")
+        if start:
+            query.filter('__key__ >', db.Key(start))
+        projects = query.fetch(settings.REPAIR_BATCH_SIZE)
+        for project in projects:
+            project.repair_counts()
+        logging.info("Repaired issue counts for %s projects" % len(projects))
+
+        if len(projects) == settings.REPAIR_BATCH_SIZE:
+            # there may be more so let the next batch be started
+            self.redirect("/admin/?repair=%s" % projects[-1].key())
+        else:
+            self.redirect("/admin/")
+
+class MigrateProjects(BaseRequest):
+    "Move projects saved before key names were used over to their slug key names"
+    def post(self):
+        # projects with numeric ids sort before those with key names,
+        # and are deleted once moved, so they're always at the start
+        projects = Project.all().order('__key__').fetch(settings.REPAIR_BATCH_SIZE)
+        legacy = [project for project in projects if project.key().name() is None]
+        for project in legacy:
+            project.migrate()
+            logging.info("project migrated: %s" % project.name)
+
+        if len(legacy) == settings.REPAIR_BATCH_SIZE:
+            # there may be more so let the next batch be started
+            self.redirect("/admin/?migrate=1")
+        else:
+            self.redirect("/admin/")
+
+class BackfillIssues(BaseRequest):
+    "Move issues onto key names made from their urls and record their identifiers"
+    def post(self):
+        query = Issue.all().order('__key__')
+        start = self.request.get("start")
+        if start:
+            query.filter('__key__ >', db.Key(start))
+        issues = query.fetch(settings.REPAIR_BATCH_SIZE)
+        for issue in issues:
+            issue.backfill()
+        logging.info("Backfilled %s issues" % len(issues))
+
+        if len(issues) == settings.REPAIR_BATCH_SIZE:
+            # there may be more so let the next batch be started
+            self.redirect("/admin/?backfill=%s" % issues[-1].key())
+        else:
+            self.redirect("/admin/")
+
+class SweepOrphans(BaseRequest):
+    "Start removing issues and the like left behind by deleted projects"
+    def post(self):
+        queue_orphan_sweep()
+        self.redirect("/admin/?sweep=1")
+
+class DeleteProjectTask(BaseRequest):
+    "Remove a batch of a deleted project's issues, queueing the next if needed"
+    def post(self):
+        deletion = ProjectDeletion.get(self.request.get("deletion"))
+        if deletion is None or deletion.finished_date:
+            return
+        if deletion.delete_batch(settings.DELETE_BATCH_SIZE):
+            logging.info("project issues deleted: %s (%s issues)" % (deletion.name, deletion.deleted))
+        else:
+            queue_project_deletion(deletion)
+
+class SweepOrphansTask(BaseRequest):
+    "Check a batch of one kind for orphans, queueing the next batch or kind"
+    def post(self):
+        kind = int(self.request.get("kind"))
+        start = self.request.get("start")
+        if start:
+            start = db.Key(start)
+        model, reference = ORPHAN_REFERENCES[kind]
+        last, removed = sweep_orphans(model, reference, start, settings.DELETE_BATCH_SIZE)
+        if removed:
+            logging.info("Removed %s orphaned %s entities" % (removed, model.kind()))
+        if last:
+            queue_orphan_sweep(kind, last)
+        elif kind + 1 < len(ORPHAN_REFERENCES):
+            queue_orphan_sweep(kind + 1)
+        else:
+            logging.info("Orphan sweep finished")
+
+class IndexIssueTask(BaseRequest):
+    "Index an issue for search once the changes queued for it have settled"
+    def post(self):
+        reindex(db.Key(self.request.get("issue")))
+
+class RequeueIndexTask(BaseRequest):
+    "Queue indexing again for issues left waiting too long, run by cron"
+    def get(self):
+        keys = stale_pending(settings.INDEX_REQUEUE_AGE, settings.INDEX_REQUEUE_BATCH_SIZE)
+        for key in keys:
+            queue_index(key, "requeue")
+        if keys:
+            logging.info("Queued indexing again for %s issues" % len(keys))
+
+class RequeueDeletionsTask(BaseRequest):
+    "Queue project deletions again when they've stopped moving, run by cron"
+    def get(self):
+        deletions = stalled_deletions(settings.DELETION_REQUEUE_AGE, settings.DELETE_BATCH_SIZE)
+        for deletion in deletions:
+            queue_project_deletion(deletion)
+        if deletions:
+            logging.info("Queued %s project deletions again" % len(deletions))
+
 class NotFoundPageHandler(BaseRequest):
     def get(self):
         self.error(404)
-        output = get_cache("error404")
-        if output is None:        
-            output = self.render("404.html")
-            memcache.add("error404", output, 3600)
+        output = cached("error404", lambda: self.render("404.html"))
         self.response.out.write(output)
 
 def application():
@@ -43,6 +179,15 @@ def application():
     ROUTES = [
         ('/admin/?$', Index),
         ('/admin/clearcache/?$', ClearCache),
+        ('/admin/repaircounts/?$', RepairCounts),
+        ('/admin/migrateprojects/?$', MigrateProjects),
+        ('/admin/backfillissues/?$', BackfillIssues),
+        ('/admin/sweeporphans/?$', SweepOrphans),
+        ('/admin/tasks/deleteproject/?$', DeleteProjectTask),
+        ('/admin/tasks/sweeporphans/?$', SweepOrphansTask),
+        ('/admin/tasks/index/?$', IndexIssueTask),
+        ('/admin/tasks/requeueindex/?$', RequeueIndexTask),
+        ('/admin/tasks/requeuedeletions/?$', RequeueDeletionsTask),
         ('/.*', NotFoundPageHandler),
     ]
     application = webapp.WSGIApplication(ROUTES, debug=settings.DEBUG)
@@ -1,4 +1,131 @@
+import calendar
+
 from google.appengine.ext import webapp
+from django import template
+from django.template import loader
+
+from lib import get_cache, set_cache, get_cache_multi, set_cache_multi, mark_slot
 
 register = webapp.template.create_template_register()
 # register.filter(filter_name)
+
+def fragment_key(name, obj):
+    """
+    Cache key for a fragment of a template showing an object, which
+    changes whenever the object is modified
+    """
+    modified = getattr(obj, 'modified_date', None)
+    if modified:
+        version = "%d%06d" % (calendar.timegm(modified.timetuple()), modified.microsecond)
+    else:
+        version = "0"
+    return "fragment_%s_%s_%s" % (name, obj.key(), version)
+
+class FragmentNode(template.Node):
+    "Renders its contents once per version of an object"
+    def __init__(self, name, obj, nodelist):
+        self.name = name
+        self.obj = obj
+        self.nodelist = nodelist
+
+    def render(self, context):
+        obj = template.resolve_variable(self.obj, context)
+        key = fragment_key(self.name, obj)
+        batch = context.get(BATCH_NAME)
+        if batch is not None:
+            found, rendered = batch
+            output = found.get(key)
+            if output is None:
+                output = self.nodelist.render(context)
+                rendered[key] = output
+            return output
+        output = get_cache(key)
+        if output is None:
+            output = self.nodelist.render(context)
+            set_cache(key, output)
+        return output
+
+def fragment(parser, token):
+    """
+    Cache the enclosed part of a template for an object until it changes.
+    Anything which differs between pages, like the loop counter, should
+    be kept outside of it.
+
+        {% fragment "issue" issue %} ... {% endfragment %}
+    """
+    bits = token.contents.split()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError("%s takes a name and an object" % bits[0])
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    return FragmentNode(bits[1].strip('"\''), bits[2], nodelist)
+
+register.tag('fragment', fragment)
+
+# context variable holding the fragments looked up for a list
+BATCH_NAME = 'fragment_batch'
+
+class FragmentsNode(template.Node):
+    "Looks up the fragments for a list of objects together"
+    def __init__(self, name, objects, nodelist):
+        self.name = name
+        self.objects = objects
+        self.nodelist = nodelist
+
+    def render(self, context):
+        objects = template.resolve_variable(self.objects, context) or []
+        found = get_cache_multi([fragment_key(self.name, obj) for obj in objects])
+        rendered = {}
+        context.push()
+        context[BATCH_NAME] = (found, rendered)
+        try:
+            output = self.nodelist.render(context)
+        finally:
+            context.pop()
+        set_cache_multi(rendered)
+        return output
+
+def fragments(parser, token):
+    """
+    Fetch the cached fragments for every object in a list with one call
+    to memcache, rather than one for each, and save those which had to
+    be rendered with one more. Wraps the loop over the list.
+
+        {% fragments "issue" issues %}
+            {% for issue in issues %}
+                {% fragment "issue" issue %} ... {% endfragment %}
+            {% endfor %}
+        {% endfragments %}
+    """
+    bits = token.contents.split()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError("%s takes a name and a list" % bits[0])
+    nodelist = parser.parse(('endfragments',))
+    parser.delete_first_token()
+    return FragmentsNode(bits[1].strip('"\''), bits[2], nodelist)
+
+register.tag('fragments', fragments)
+
+class SlotNode(template.Node):
+    "Renders a template marked out so it can be replaced per user"
+    def __init__(self, name):
+        self.name = name
+
+    def render(self, context):
+        output = loader.get_template(self.name).render(context)
+        return mark_slot(self.name, output)
+
+def slot(parser, token):
+    """
+    Include a template whose output depends on the current user. Pages
+    are cached as seen when logged out, then each slot is rendered again
+    for a logged in user when the page is sent to them.
+
+        {% slot "_greeting.html" %}
+    """
+    bits = token.contents.split()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError("%s takes a template name" % bits[0])
+    return SlotNode(bits[1].strip('"\''))
+
+register.tag('slot', slot)
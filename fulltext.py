@@ -0,0 +1,267 @@
+import re
+import bisect
+import hashlib
+from datetime import datetime, timedelta
+
+from google.appengine.ext import db
+
+from lib import cached, invalidate_cache
+from rpc import fetch_async, wait
+import settings
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# words too common to be worth indexing
+STOP_WORDS = set("""
+a about an and are as at be but by can do does for from has have how i if
+in into is it its not of on or so that the their then there these this to
+was we were what when where which who will with you your
+""".split())
+
+# suffixes removed when stemming, longest first
+SUFFIXES = ['ational', 'ization', 'fulness', 'iveness', 'ousness', 'tional',
+    'ation', 'ments', 'ness', 'ment', 'able', 'ible', 'ings', 'ing', 'ies',
+    'ied', 'ers', 'ed', 'er', 'ly', 's']
+
+# how much more a word in the name counts than one in the description
+NAME_WEIGHT = 3
+
+def stem(word):
+    """
+    Reduce a word to a simple stem, so that crash, crashes, crashed and
+    crashing are all indexed the same. Much simpler than a full stemmer,
+    but it only has to agree with itself
+    """
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            if suffix in ('ies', 'ied'):
+                word += 'y'
+            break
+    if word.endswith('e') and len(word) > 4:
+        word = word[:-1]
+    return word
+
+def tokenize(text):
+    "Split text into a list of stemmed words, leaving out common words"
+    words = []
+    for word in WORD_RE.findall(unicode(text or "").lower()):
+        if len(word) > 1 and not word in STOP_WORDS:
+            words.append(stem(word))
+    return words
+
+def term_weights(name, description):
+    "Score each stemmed word by how often it's used, counting the name more"
+    weights = {}
+    for word in tokenize(name):
+        weights[word] = weights.get(word, 0) + NAME_WEIGHT
+    for word in tokenize(description):
+        weights[word] = weights.get(word, 0) + 1
+    return weights
+
+class SearchDocument(db.Model):
+    """
+    The searchable words of an issue, kept apart from the issue so it
+    only needs writing when the name or description changes. The list of
+    terms is indexed by the datastore, which makes it an inverted index
+    """
+    project = db.ReferenceProperty()
+    issue = db.ReferenceProperty()
+    terms = db.StringListProperty()
+    # term and weight pairs, used to rank matches but never queried
+    weights = db.TextProperty()
+
+    @classmethod
+    def key_for(cls, issue_key):
+        "Key of the document for an issue, which shares its key name or id"
+        if issue_key.name():
+            return db.Key.from_path(cls.kind(), issue_key.name())
+        return db.Key.from_path(cls.kind(), "id/%s" % issue_key.id())
+
+    def weight_map(self):
+        "Read the stored weights back into a dictionary"
+        parts = (self.weights or "").split()
+        return dict([(parts[i], int(parts[i + 1])) for i in range(0, len(parts), 2)])
+
+def document_for(issue):
+    "Build the search document for an issue, ready to save"
+    weights = term_weights(issue.name, issue.description)
+    if len(weights) > settings.SEARCH_MAX_TERMS:
+        # only the most used words of very long descriptions are kept
+        ranked = sorted([(-weight, term) for term, weight in weights.items()])
+        weights = dict([(term, -weight) for weight, term in ranked[:settings.SEARCH_MAX_TERMS]])
+    return SearchDocument(
+        key_name=SearchDocument.key_for(issue.key()).name(),
+        project=issue.project,
+        issue=issue,
+        terms=sorted(weights.keys()),
+        weights=db.Text(" ".join(["%s %s" % pair for pair in sorted(weights.items())])),
+    )
+
+class IndexPending(db.Model):
+    """
+    Marks an issue whose search document is out of date until the queued
+    indexing catches up. It shares the document's key name, so however
+    often an issue changes there is only ever one
+    """
+    issue = db.ReferenceProperty()
+    modified_date = db.DateTimeProperty()
+
+    @classmethod
+    def key_for(cls, issue_key):
+        "Key of the marker for an issue"
+        return db.Key.from_path(cls.kind(), SearchDocument.key_for(issue_key).name())
+
+def pending_for(issue):
+    "Build the marker recording that an issue needs indexing, ready to save"
+    return IndexPending(
+        key_name=SearchDocument.key_for(issue.key()).name(),
+        issue=issue,
+        modified_date=issue.modified_date,
+    )
+
+def search_dependency(project_key):
+    """
+    Name of the cache dependency for search results in a project, which
+    change when queued indexing finishes rather than when issues are saved
+    """
+    return "search_%s" % project_key
+
+def reindex(issue_key):
+    """
+    Bring the search document for an issue up to date with however it
+    is now, called from the queue once its changes have settled
+    """
+    # suggest matches words the way this module does so can't be imported first
+    from suggest import issue_indexed
+    issue = db.get(issue_key)
+    if issue is None:
+        # deleted since it was queued, which removed its document too
+        db.delete(IndexPending.key_for(issue_key))
+        issue_indexed(issue_key, None)
+        return
+    document = document_for(issue)
+    document.put()
+    # a change saved since the issue was read is indexed by its own task
+    pending = IndexPending.get(IndexPending.key_for(issue_key))
+    if pending and pending.modified_date <= issue.modified_date:
+        pending.delete()
+    invalidate_cache(search_dependency(SearchDocument.project.get_value_for_datastore(document)))
+    issue_indexed(issue_key, issue)
+
+def index_lag():
+    """
+    How far indexing is behind, as the number of issues waiting (up to
+    a thousand) and the time the longest waiting one was changed
+    """
+    oldest = IndexPending.all().order('modified_date').get()
+    if oldest is None:
+        return 0, None
+    return IndexPending.all(keys_only=True).count(1000), oldest.modified_date
+
+def stale_pending(age, size):
+    """
+    Keys of the issues which have waited longer than age seconds to be
+    indexed, oldest first, as their task was probably never queued
+    """
+    cutoff = datetime.now() - timedelta(seconds=age)
+    markers = IndexPending.all().filter('modified_date <', cutoff).order('modified_date').fetch(size)
+    return [IndexPending.issue.get_value_for_datastore(marker) for marker in markers]
+
+def query_terms(text):
+    "The distinct stemmed words of a search, in a stable order"
+    return sorted(set(tokenize(text)))
+
+def matching(project_key, terms):
+    "Query for the documents in a project containing every one of the terms"
+    query = SearchDocument.all().filter('project =', project_key)
+    for term in terms:
+        query.filter('terms =', term)
+    return query
+
+def rank(documents, terms):
+    """
+    Score documents by the weight of each term in them, returning
+    (score, issue key) pairs best first
+    """
+    scored = []
+    for document in documents:
+        weights = document.weight_map()
+        score = sum([weights.get(term, 0) for term in terms])
+        scored.append((-score, str(SearchDocument.issue.get_value_for_datastore(document))))
+    scored.sort()
+    return [(-score, db.Key(key)) for score, key in scored]
+
+def search(project_key, text):
+    """
+    Find the issues in a project matching every word of a search, best
+    first, returning a list of issue keys. Only the first SEARCH_CANDIDATES
+    matches are ranked, so very broad searches may miss some issues
+    """
+    terms = query_terms(text)
+    if not terms:
+        return []
+    documents = matching(project_key, terms).fetch(settings.SEARCH_CANDIDATES)
+    return [key for score, key in rank(documents, terms)]
+
+def search_projects(project_keys, text):
+    """
+    Search several projects at once, returning (score, issue key) pairs
+    best first. Up to SEARCH_MAX_PROJECTS projects are queried in parallel.
+    Beyond that a single query for the words is filtered down to the
+    projects, so only the first SEARCH_GLOBAL_CANDIDATES matches in any
+    project are ranked
+    """
+    terms = query_terms(text)
+    if not terms or not project_keys:
+        return []
+    if len(project_keys) <= settings.SEARCH_MAX_PROJECTS:
+        calls = [fetch_async(matching(key, terms), settings.SEARCH_CANDIDATES)
+            for key in project_keys]
+        documents = []
+        for found in wait(*calls):
+            documents.extend(found)
+    else:
+        visible = set([str(key) for key in project_keys])
+        query = SearchDocument.all()
+        for term in terms:
+            query.filter('terms =', term)
+        documents = [document for document in query.fetch(settings.SEARCH_GLOBAL_CANDIDATES)
+            if str(SearchDocument.project.get_value_for_datastore(document)) in visible]
+    return rank(documents, terms)[:settings.SEARCH_MAX_RESULTS]
+
+def search_visible(project_keys, text):
+    """
+    Search several projects as search_projects does, through a cache
+    shared by everyone who can see the same projects, returning (score,
+    issue key string) pairs. Results are rebuilt when queued indexing
+    finishes in any of the projects
+    """
+    project_keys = sorted(project_keys, key=str)
+    terms = " ".join(query_terms(text))
+    search_key = u"%s|%s" % (terms, ",".join([str(key) for key in project_keys]))
+    return cached("search_%s" % hashlib.md5(search_key.encode('utf8')).hexdigest(),
+        lambda: [(score, str(issue)) for score, issue in search_projects(project_keys, text)],
+        depends=[search_dependency(key) for key in project_keys])
+
+def result_cursor(result):
+    "Cursor for the results ranked after a (score, issue key) result"
+    score, issue = result
+    return "%s:%s" % (score, issue)
+
+def results_after(results, cursor):
+    """
+    The ranked results which follow the one a cursor was made from. As
+    the cursor holds the result rather than its position, paging stays
+    in step when results ahead of it are added or removed. Raises
+    ValueError for a cursor which wasn't made by result_cursor
+    """
+    if not cursor:
+        return results
+    score, issue = cursor.split(":", 1)
+    try:
+        position = (-int(score), str(db.Key(issue)))
+    except db.BadKeyError:
+        raise ValueError("not a cursor: %s" % cursor)
+    start = bisect.bisect_right([(-score, issue) for score, issue in results], position)
+    return results[start:]
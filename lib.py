@@ -3,7 +3,16 @@ import re
 import logging
 import unicodedata
 import sys
+import time
+import random
+import calendar
+import hashlib
+import gzip
+from StringIO import StringIO
+import threading
 import traceback
+from datetime import datetime, timedelta
+from email.utils import formatdate, parsedate
 
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
@@ -26,10 +35,104 @@ def textile(value):
     value = real_textile(value, sanitize=1)
     return value
 
+def compress(value):
+    "Gzip a string"
+    buffer = StringIO()
+    zipped = gzip.GzipFile(fileobj=buffer, mode='wb')
+    zipped.write(value)
+    zipped.close()
+    return buffer.getvalue()
+
+def decompress(value):
+    "Expand a gzipped string"
+    return gzip.GzipFile(fileobj=StringIO(value), mode='rb').read()
+
+# marks the parts of a page which depend on the current user
+SLOT_RE = re.compile(r'<!--slot:([\w.-]+)-->.*?<!--/slot:\1-->', re.DOTALL)
+
+def mark_slot(name, output):
+    "Wrap the output of a slot template so it can be found later"
+    return "<!--slot:%s-->%s<!--/slot:%s-->" % (name, output, name)
+
+def fill_slots(body, render):
+    "Replace each slot in a page with the output of render(template name)"
+    def replace(match):
+        output = render(match.group(1))
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        return output
+    return SLOT_RE.sub(replace, body)
+
+def response_entry(body, modified=None):
+    """
+    Wrap a response body with the validators needed to answer
+    conditional requests. This is what cached handlers store.
+    Large bodies are kept gzipped, ready to send as they are.
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if modified is None:
+        modified = datetime.now()
+    entry = {
+        'etag': '"%s"' % hashlib.md5(body).hexdigest(),
+        # http dates only go down to the second
+        'modified': modified.replace(microsecond=0),
+        'gzip': len(body) >= settings.GZIP_MIN_SIZE,
+    }
+    if entry['gzip']:
+        entry['body'] = compress(body)
+    else:
+        entry['body'] = body
+    return entry
+
+def accepts_gzip(request):
+    "Check if the client will take a gzipped response"
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        parts = [part.strip() for part in coding.split(';')]
+        if parts[0] == 'gzip':
+            # a quality of zero, however it's written, means no
+            for part in parts[1:]:
+                if part.startswith('q='):
+                    try:
+                        return float(part[2:]) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+def http_date(value):
+    "Format a datetime, in UTC, for use in a HTTP header"
+    return formatdate(calendar.timegm(value.timetuple()), usegmt=True)
+
+def not_modified(request, entry, etag):
+    "Check if the client already has the current version of a response"
+    etags = request.headers.get('If-None-Match')
+    if etags:
+        etags = [value.strip() for value in etags.split(',')]
+        return '*' in etags or etag in etags
+    since = request.headers.get('If-Modified-Since')
+    if since:
+        # some clients add a length after a semicolon
+        parsed = parsedate(since.split(';')[0])
+        if parsed:
+            return entry['modified'] <= datetime(*parsed[:6])
+    return False
+
 class BaseRequest(webapp.RequestHandler):
     "Extended request object with extra functionality"
+
+    # name of the entry in settings.CACHE_CONTROL saying how long
+    # browsers and proxies can keep this handler's public responses
+    cache_policy = None
+
+    def initialize(self, request, response):
+        "Nothing may be kept by browsers or proxies unless we say so"
+        super(BaseRequest, self).initialize(request, response)
+        self.response.headers["Cache-Control"] = "private, no-store"
+        # entities are only shared within a single request
+        IDENTITY_MAP.clear()
     
-    def _extra_context(self, context):   
+    def _extra_context(self, context, anonymous=False):   
         """
         Common context information is stored here, rather than
         being added to every view
@@ -37,7 +140,10 @@ class BaseRequest(webapp.RequestHandler):
         
         # get a login or logout link depending on whether
         # we are logged in or not
-        user = users.get_current_user()
+        if anonymous:
+            user = None
+        else:
+            user = users.get_current_user()
         if user:
             link = users.create_logout_url("/")
         else:
@@ -52,36 +158,82 @@ class BaseRequest(webapp.RequestHandler):
         context.update(extras)
         return context
         
-    def render(self, template_file, context={}):
-        "Helper to deal with rendering a context to a template"
+    def render(self, template_file, context={}, anonymous=False):
+        """
+        Helper to deal with rendering a context to a template. Pages which
+        are shared between users are rendered as if nobody is logged in
+        """
         path = os.path.join(os.path.dirname(__file__), 'templates',
             template_file)
         # render the template with the provided context
         # adding in the extra context variables at the same time
-        output = template.render(path, self._extra_context(context))
+        output = template.render(path, self._extra_context(dict(context), anonymous))
         return output
         
+    def write_entry(self, entry, content_type=None):
+        """
+        Write a response entry with its validators, or just a 304 if the
+        client sent a conditional request and its copy is current
+        """
+        if content_type:
+            self.response.headers["Content-Type"] = content_type
+        body = entry['body']
+        etag = entry['etag']
+        vary = []
+
+        # responses for logged out users can be shared by front end caches,
+        # which need to keep them apart from those for logged in users
+        max_age = settings.CACHE_CONTROL.get(self.cache_policy)
+        if max_age and not users.get_current_user():
+            self.response.headers["Cache-Control"] = "public, max-age=%d" % max_age
+            self.response.headers["Expires"] = http_date(
+                datetime.utcnow() + timedelta(seconds=max_age))
+            vary.append("Cookie")
+
+        if entry['gzip']:
+            vary.append("Accept-Encoding")
+            if accepts_gzip(self.request):
+                # the gzipped version needs a different strong etag
+                etag = '%s-gzip"' % etag[:-1]
+                self.response.headers["Content-Encoding"] = "gzip"
+            else:
+                body = decompress(body)
+        if vary:
+            self.response.headers["Vary"] = ", ".join(vary)
+        self.response.headers["ETag"] = etag
+        self.response.headers["Last-Modified"] = http_date(entry['modified'])
+        if not_modified(self.request, entry, etag):
+            self.response.set_status(304)
+            return
+        self.response.out.write(body)
+
+    def write_personal(self, entry, context={}, content_type=None):
+        """
+        Write a shared response entry for the current user, rendering
+        each slot in it again with the user and the given context
+        """
+        if content_type:
+            self.response.headers["Content-Type"] = content_type
+        body = entry['body']
+        if entry['gzip']:
+            body = decompress(body)
+        output = fill_slots(body, lambda name: self.render(name, context))
+        self.response.out.write(output)
+
     def render_403(self):
         "Custom authentication required view"
         self.error(403)
         logging.info("unauthorised attempt to access: %s" % self.request.path)
-        output = get_cache("error403")
-        if output is None:        
-            output = self.render("403.html")
-            memcache.add("error403", output, 3600)
+        output = cached("error403", lambda: self.render("403.html"))
         self.response.out.write(output)
 
     def render_404(self):
         "Not found helper"
         self.error(404)
-        user = users.get_current_user()
-        output = None
-        if not user:
-            output = get_cache("error404")
-        if output is None:        
+        if users.get_current_user():
             output = self.render("404.html")
-            if not user:
-                memcache.add("error404", output, 3600)
+        else:
+            output = cached("error404", lambda: self.render("404.html"))
         self.response.out.write(output)
                 
     def handle_exception(self, exception, debug_mode): 
@@ -95,9 +247,365 @@ class BaseRequest(webapp.RequestHandler):
         output = self.render('500.html', context)
         self.response.out.write(output)
             
-def get_cache(key):
-    "Cache helper which checks if we have the cache enabled first"
-    if settings.CACHE:
-        return memcache.get(key)
+class IdentityMap(threading.local):
+    """
+    Datastore entities fetched while handling the current request, by
+    key, so the same entity is only fetched once per request
+    """
+
+    def __init__(self):
+        self.entities = {}
+
+    def clear(self):
+        "Forget everything, ready for a new request"
+        self.entities = {}
+
+    def get(self, key):
+        "Get an entity already fetched, or None"
+        return self.entities.get(key)
+
+    def add(self, entity):
+        "Remember an entity fetched or saved in this request"
+        self.entities[entity.key()] = entity
+
+    def delete(self, key):
+        "Forget an entity which has been deleted"
+        self.entities.pop(key, None)
+
+IDENTITY_MAP = IdentityMap()
+
+class LocalCache(object):
+    """
+    Least recently used cache held in instance memory, limited to a
+    total size in bytes with a timeout on each value
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        "Empty the cache"
+        self.lock.acquire()
+        try:
+            # entries are kept in a circular doubly linked list of
+            # [previous, next, key, value, size, expires] with the most
+            # recently used entry just after the root
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None, 0, None]
+            self.entries = {}
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        "Get a value, or None if it's missing or has expired"
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[5] < time.time():
+                self._remove(entry)
+                return None
+            # move the entry to the front of the list
+            self._unlink(entry)
+            self._link(entry)
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, timeout):
+        "Store a value for timeout seconds, evicting old values if needed"
+        size = sizeof(key) + sizeof(value)
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._remove(self.entries[key])
+            if size > self.max_bytes:
+                return
+            while self.bytes + size > self.max_bytes:
+                # the least recently used entry is at the back of the list
+                self._remove(self.root[0])
+            entry = [None, None, key, value, size, time.time() + timeout]
+            self._link(entry)
+            self.entries[key] = entry
+            self.bytes += size
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        "Remove a value if present"
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._remove(self.entries[key])
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _link(self, entry):
+        entry[0] = self.root
+        entry[1] = self.root[1]
+        self.root[1][0] = entry
+        self.root[1] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self.entries[entry[2]]
+        self.bytes -= entry[4]
+
+def sizeof(value):
+    "Rough size in bytes of a cached value"
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum([sizeof(key) + sizeof(item) for key, item in value.items()])
+    if isinstance(value, (list, tuple)):
+        return sum([sizeof(item) for item in value])
+    return 16
+
+# the first cache tier, shared by every request served by this instance
+LOCAL_CACHE = LocalCache(settings.LOCAL_CACHE_SIZE)
+
+# hits and misses for each cache tier since this instance started
+CACHE_STATS = {
+    'local_hits': 0,
+    'local_misses': 0,
+    'memcache_hits': 0,
+    'memcache_misses': 0,
+}
+
+def cache_stats():
+    "Get the per tier hit and miss counts for this instance"
+    return dict(CACHE_STATS)
+
+# longest key memcache accepts
+MAX_KEY_LENGTH = 250
+
+def generation_key(dependency):
+    "Memcache key holding the current generation of a dependency"
+    return "generation_%s" % dependency
+
+def generations(dependencies):
+    """
+    Get the current generation of each dependency. Missing counters are
+    started from a random 63 bit number rather than the time, as busy
+    counters move on many times a second, so one which has been evicted
+    won't come back to a generation values are still cached under
+    """
+    keys = [generation_key(dependency) for dependency in dependencies]
+    if not keys:
+        return []
+    # generations are held briefly in instance memory, which bounds how
+    # long a write made by another instance takes to be seen here
+    found = {}
+    for key in keys:
+        value = LOCAL_CACHE.get(key)
+        if value is not None:
+            found[key] = value
+    missing = [key for key in keys if key not in found]
+    if missing:
+        found.update(memcache.get_multi(missing))
+        unstarted = [key for key in missing if key not in found]
+        if unstarted:
+            memcache.add_multi(dict([(key, random.getrandbits(63)) for key in unstarted]))
+            # another request might have started the counter first
+            found.update(memcache.get_multi(unstarted))
+        for key in missing:
+            if key in found:
+                LOCAL_CACHE.set(key, found[key], settings.LOCAL_GENERATION_TIME)
+    return [found.get(key, 0) for key in keys]
+
+def versioned_key(key, depends=()):
+    """
+    Build the real cache key for a value from the current generation of
+    everything it depends on. Invalidating a dependency moves it on to a
+    new generation, so every key built from the old one is never read again
+    """
+    if not depends:
+        return key
+    versions = "_".join([str(value) for value in generations(depends)])
+    if len(key) + len(versions) >= MAX_KEY_LENGTH:
+        # values depending on many things would go over memcache's limit
+        versions = hashlib.md5(versions).hexdigest()
+    return "%s_%s" % (key, versions)
+
+def get_cache(key, depends=()):
+    """
+    Cache helper which checks if we have the cache enabled first, then
+    looks in instance memory before making a call to memcache
+    """
+    if not settings.CACHE:
+        return None
+    return _get_cache(versioned_key(key, depends))
+
+def set_cache(key, value, timeout=None, depends=()):
+    """
+    Cache helper which stores a value against the current generation
+    of the dependencies it was built from
+    """
+    if not settings.CACHE:
+        return
+    _set_cache(versioned_key(key, depends), value, timeout)
+
+def get_cache_multi(keys):
+    """
+    Look up several values at once, from instance memory and then with
+    a single call to memcache, returning a dictionary of those found
+    """
+    if not settings.CACHE or not keys:
+        return {}
+    found = {}
+    for key in keys:
+        value = LOCAL_CACHE.get(key)
+        if value is not None:
+            found[key] = value
+    CACHE_STATS['local_hits'] += len(found)
+    missing = [key for key in keys if key not in found]
+    CACHE_STATS['local_misses'] += len(missing)
+    if missing:
+        fetched = memcache.get_multi(missing)
+        CACHE_STATS['memcache_hits'] += len(fetched)
+        CACHE_STATS['memcache_misses'] += len(missing) - len(fetched)
+        for key, value in fetched.items():
+            LOCAL_CACHE.set(key, value, settings.LOCAL_CACHE_TIME)
+        found.update(fetched)
+    return found
+
+def set_cache_multi(values, timeout=None):
+    "Store a dictionary of values with a single call to memcache"
+    if not settings.CACHE or not values:
+        return
+    if timeout is None:
+        timeout = settings.CACHE_TIME
+    memcache.set_multi(values, timeout)
+    for key, value in values.items():
+        LOCAL_CACHE.set(key, value, min(timeout, settings.LOCAL_CACHE_TIME))
+
+def page_key(key, cursor):
+    """
+    Cache key for a page of results, as cursors from later pages are
+    too long to use in a key themselves
+    """
+    if not cursor:
+        return key
+    if isinstance(cursor, unicode):
+        cursor = cursor.encode('utf-8')
+    return "%s_%s" % (key, hashlib.md5(cursor).hexdigest())
+
+def delete_cache(key, depends=()):
+    "Remove a value from instance memory and memcache"
+    key = versioned_key(key, depends)
+    LOCAL_CACHE.delete(key)
+    memcache.delete(key)
+
+def cached(key, compute, timeout=None, depends=(), refresh=None):
+    """
+    Get a value from the cache, or call compute to build it if missing.
+    Only one request rebuilds a missing value at a time, using a memcache
+    lock, while any others wait briefly for it to appear. A value of None
+    from compute is returned but not cached.
+
+    If refresh is given the value is rebuilt after that many seconds, but
+    the stale copy is kept for the full timeout and served to every other
+    request while one of them rebuilds it.
+    """
+    if not settings.CACHE:
+        return compute()
+    key = versioned_key(key, depends)
+    lock = "lock_%s" % key
+
+    entry = _get_cache(key)
+    if entry is not None:
+        if refresh is None:
+            return entry
+        if entry['refresh'] > time.time():
+            return entry['value']
+        # the copy in instance memory may be older than the one in memcache
+        latest = memcache.get(key)
+        if latest is not None and latest['refresh'] > time.time():
+            LOCAL_CACHE.set(key, latest, settings.LOCAL_CACHE_TIME)
+            return latest['value']
+        if not memcache.add(lock, 1, settings.CACHE_LOCK_TIME):
+            # someone else is already rebuilding it
+            return entry['value']
+        return _rebuild(key, lock, compute, timeout, refresh)
+
+    if memcache.add(lock, 1, settings.CACHE_LOCK_TIME):
+        return _rebuild(key, lock, compute, timeout, refresh)
+
+    # another request is already building the value so wait for it
+    waited = 0
+    while waited < settings.CACHE_LOCK_WAIT:
+        time.sleep(settings.CACHE_LOCK_POLL)
+        waited += settings.CACHE_LOCK_POLL
+        entry = memcache.get(key)
+        if entry is not None:
+            LOCAL_CACHE.set(key, entry, settings.LOCAL_CACHE_TIME)
+            if refresh is None:
+                return entry
+            return entry['value']
+        if memcache.get(lock) is None:
+            # the lock was released without a value being cached, as it
+            # was None or building it failed, so there's nothing to wait for
+            return compute()
+    # it's taking too long, so build it here without caching
+    logging.info("gave up waiting for cache lock: %s" % key)
+    return compute()
+
+def _rebuild(key, lock, compute, timeout, refresh):
+    "Build a value while holding its lock and store it in the cache"
+    try:
+        value = compute()
+        if value is not None:
+            if refresh is None:
+                _set_cache(key, value, timeout)
+            else:
+                _set_cache(key, {
+                    'value': value,
+                    'refresh': time.time() + refresh,
+                }, timeout)
+    finally:
+        memcache.delete(lock)
+    return value
+
+def _get_cache(key):
+    "Get a value from instance memory or memcache by its versioned key"
+    value = LOCAL_CACHE.get(key)
+    if value is not None:
+        CACHE_STATS['local_hits'] += 1
+        return value
+    CACHE_STATS['local_misses'] += 1
+    value = memcache.get(key)
+    if value is None:
+        CACHE_STATS['memcache_misses'] += 1
     else:
-        return None
\ No newline at end of file
+        CACHE_STATS['memcache_hits'] += 1
+        LOCAL_CACHE.set(key, value, settings.LOCAL_CACHE_TIME)
+    return value
+
+def _set_cache(key, value, timeout=None):
+    "Store a value in memcache and instance memory by its versioned key"
+    if timeout is None:
+        timeout = settings.CACHE_TIME
+    memcache.set(key, value, timeout)
+    LOCAL_CACHE.set(key, value, min(timeout, settings.LOCAL_CACHE_TIME))
+
+def invalidate_cache(*dependencies):
+    "Make every cached value built from the given dependencies stale"
+    for dependency in dependencies:
+        key = generation_key(dependency)
+        # a missing counter will be started afresh when next read
+        value = memcache.incr(key)
+        if value is None:
+            LOCAL_CACHE.delete(key)
+        else:
+            LOCAL_CACHE.set(key, value, settings.LOCAL_GENERATION_TIME)
@@ -2,10 +2,10 @@
 
 import re
 import os
+import urllib
 import logging
 from datetime import datetime
 
-from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.api import users
@@ -14,9 +14,15 @@ from google.appengine.api import mail
 
 from django.utils import simplejson
 
-from lib import BaseRequest, get_cache, slugify
+from lib import BaseRequest, cached, response_entry, slugify, page_key
+from fulltext import search, search_dependency, search_visible
+from fulltext import result_cursor, results_after
+from suggest import suggest
 import settings
-from models import Project, Issue
+from models import Project, Issue, IssueSummary, PROJECTS_DEPENDENCY, project_dependency, get_project
+from models import get_issue, get_issues_by_identifier, fetch_page, project_key
+from models import DuplicateIssue, DuplicateProject
+from rpc import fetch_async, wait
 from ext.PyRSS2Gen import RSS2, RSSItem
 
 webapp.template.register_template_library('filters')
@@ -36,74 +42,111 @@ URL_RE = re.compile(
 
 class Index(BaseRequest):
     "Home page. Shows either introductory info or a list of the users projects"
+    cache_policy = "home"
+
     def get(self):
         if users.get_current_user():
-            # if we have a user then get their projects
-            projects = Project.all().filter('user =', users.get_current_user()).order('-created_date').fetch(50)
+            # if we have a user then get a page of their projects
+            cursor = self.request.get("cursor")
+            query = Project.all().filter('user =', users.get_current_user()).order('-created_date')
+            page = fetch_page(query, cursor, settings.PROJECTS_PAGE_SIZE)
+            if page is None:
+                self.render_404()
+                return
+            projects, next_cursor = page
             context = {
                 'projects': projects,
+                'cursor': cursor,
+                'next_cursor': next_cursor,
             }
-            output = self.render("index.html", context)
+            entry = response_entry(self.render("index.html", context))
         else:
             # otherwise it's a static page so cache for a while
-            output = get_cache("home")
-            if output is None:
-                output = self.render("home.html")
-                memcache.add("home", output, 3600)
-        self.response.out.write(output)
+            entry = cached("home", lambda: response_entry(self.render("home.html")))
+        self.write_entry(entry)
 
 class ProjectHandler(BaseRequest):
     "Individual project details and issue adding"
+    cache_policy = "project"
+
     def get(self, slug):
         # we want canonocal urls so redirect to add a trailing slash if needed
         if self.request.path[-1] != "/":
             self.redirect("%s/" % self.request.path, True)
             return
         
+        # everyone shares the page cached for logged out users,
+        # with each page of issues cached separately
+        cursor = self.request.get("cursor")
+        entry = cached(page_key("project_%s" % slug, cursor), lambda: self._render(slug, cursor),
+            depends=[project_dependency(slug)])
+        if entry is None:
+            self.render_404()
+            return
+
         user = users.get_current_user()
-        output = None
-        
-        # if not logged in then use a cached version
-        if not user:
-            output = get_cache("project_%s" % slug)
-        
-        # if we don't have a cached version or are logged in
-        if output is None:
-            try:
-                project = Project.all().filter('slug =', slug).fetch(1)[0]        
-                issues = Issue.all().filter('project =', project)
-            except IndexError:
-                self.render_404()
-                return 
-            
-            # check to see if we have admin rights over this project
-            if project.user == user or users.is_current_user_admin():
-                owner = True
-            else:
-                owner = False            
-            
+        if user:
+            # fill in the parts which depend on who is looking
+            project = get_project(slug)
             context = {
                 'project': project,
-                'issues': issues,
-                'owner': owner,
+                'owner': self._is_owner(project, user),
             }
-            output = self.render("project.html", context)
-        if not user:
-            # only save a cached version if we're not logged in
-            # so as to avoid revelaving user details
-            memcache.add("project_%s" % slug, output, 3600)
-        self.response.out.write(output)
+            self.write_personal(entry, context)
+        else:
+            self.write_entry(entry)
+
+    def _is_owner(self, project, user):
+        "Check to see if we have admin rights over this project"
+        return project.user == user or users.is_current_user_admin()
+
+    def _render(self, slug, cursor=None):
+        """
+        Render the shared project page with a page of issues starting
+        at the cursor, or return None if there isn't one
+        """
+        project = get_project(slug)
+        if project is None:
+            return None
+        page = fetch_page(IssueSummary.all().filter('project =', project), cursor,
+            settings.ISSUES_PAGE_SIZE)
+        if page is None:
+            return None
+        issues, next_cursor = page
+        
+        context = {
+            'project': project,
+            'issues': issues,
+            # the counts are kept on the project so nothing is counted here
+            'issue_count': project.open_count + project.closed_count,
+            'cursor': cursor,
+            'next_cursor': next_cursor,
+            'owner': False,
+        }
+        # dated when built, as editing an issue doesn't save the project
+        return response_entry(self.render("project.html", context, anonymous=True))
         
     def post(self, slug):
         "Create an issue against this project"
-        project = Project.all().filter('slug =', slug).fetch(1)[0]
         # get details from the form
         name = self.request.get("name")
         description = self.request.get("description")
         email = self.request.get("email")
+
+        # look for an issue saved with the same url before key names
+        # were used while fetching the project. Issue.put checks for
+        # one stored under the key name itself
+        issue_slug = slugify(unicode(name))
+        by_url = fetch_async(Issue.all(keys_only=True).filter(
+            'internal_url =', "/%s/%s/" % (slug, issue_slug)), 1)
+        project = get_project(slug)
+        if project is None:
+            self.render_404()
+            return
         
         try:
-            if Issue.all().filter('name =', name).filter('project =', project).count() == 0:
+            legacy = by_url.get_result()
+            if not legacy:
                 issue = Issue(
                     name=name,
                     description=description,
@@ -123,6 +166,8 @@ Description: %s
 Thanks for using GitBug <http://gitbug.appspot.com>. A very simple issue tracker.
     """ % (issue.name, issue.description))
                 logging.info("issue created: %s in %s" % (name, project.name))
+        except DuplicateIssue:
+            logging.info("issue already exists: %s in %s" % (name, project.name))
         except Exception, e:
             logging.error("error adding issue: %s" % e)
         
@@ -130,109 +175,186 @@ Thanks for using GitBug <http://gitbug.appspot.com>. A very simple issue tracker
 
 class ProjectJsonHandler(BaseRequest):
     "Project information in JSON"
-    def get(self, slug):
-        output = get_cache("project_%s_json" % slug)
-        if output is None:
-            project = Project.all().filter('slug =', slug).fetch(1)[0]        
-            issues = Issue.all().filter('project =', project).order('fixed').order('created_date')
-
-            issues_data = {}
-            for issue in issues:
-                # friendlier display of information
-                if issue.fixed: 
-                    status = "Fixed"
-                else:
-                    status = "Open"
+    cache_policy = "json"
 
-                # set structure of inner json
-                data = {
-                    'internal_url': "%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
-                    'created_date': str(project.created_date)[0:19],
-                    'description': issue.html,
-                    'status': status,
-                    'identifier': "#gitbug%s" % issue.identifier,
-                }
-                if issue.fixed and issue.fixed_description:
-                    data['fixed_description'] = issue.fixed_description
-                issues_data[issue.name] = data
+    def get(self, slug):
+        entry = cached("project_%s_json" % slug, lambda: self._json(slug),
+            depends=[project_dependency(slug)], refresh=settings.JSON_REFRESH_TIME)
+        if entry is None:
+            self.render_404()
+            return
+        # send the correct headers
+        self.write_entry(entry, "application/javascript; charset=utf8")
+
+    def _json(self, slug):
+        "Build the JSON for a project, or return None if there isn't one"
+        project = get_project(slug)
+        if project is None:
+            return None
+        issues = IssueSummary.all().filter('project =', project).order('fixed').order('created_date')
+
+        issues_data = {}
+        for issue in issues:
+            # friendlier display of information
+            if issue.fixed: 
+                status = "Fixed"
+            else:
+                status = "Open"
 
-            # set structure of outer json
-            json = {
-                'date': str(datetime.now())[0:19],
-                'name': project.name,
-                'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
+            # set structure of inner json
+            data = {
+                'internal_url': "%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
                 'created_date': str(project.created_date)[0:19],
-                'issues': issues_data,
+                'description': issue.excerpt,
+                'status': status,
+                'identifier': "#gitbug%s" % issue.identifier,
             }
-            
-            if project.url:
-                json['external_url'] = project.url
+            issues_data[issue.name] = data
+
+        # set structure of outer json
+        json = {
+            'date': str(datetime.now())[0:19],
+            'name': project.name,
+            'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
+            'created_date': str(project.created_date)[0:19],
+            'issues': issues_data,
+        }
+        
+        if project.url:
+            json['external_url'] = project.url
 
-            # create the json
-            output = simplejson.dumps(json)
-            # cache it
-            memcache.add("project_%s_json" % slug, output, 3600)
-        # send the correct headers
-        self.response.headers["Content-Type"] = "application/javascript; charset=utf8"
-        self.response.out.write(output)
+        # create the json
+        return response_entry(simplejson.dumps(json))
         
+class ProjectSearchHandler(BaseRequest):
+    "Search the issues of a project by the words in their name and description"
+    cache_policy = "search"
+
+    def get(self, slug):
+        text = self.request.get("q")
+        try:
+            page = max(int(self.request.get("page") or 1), 1)
+        except ValueError:
+            page = 1
+
+        # indexing moves on the dependency for the project's real key,
+        # which for projects not yet migrated isn't the one made from
+        # the slug, so the project is needed first
+        project = get_project(slug)
+        if project is None:
+            self.render_404()
+            return
+        # the page shows the search as it was typed so is cached by
+        # that, and rebuilt when queued indexing finishes
+        entry = cached(page_key("search_%s_%s" % (slug, page), text),
+            lambda: self._render(project, text, page),
+            depends=[project_dependency(slug), search_dependency(project.key())])
+        if users.get_current_user():
+            self.write_personal(entry)
+        else:
+            self.write_entry(entry)
+
+    def _render(self, project, text, page):
+        "Render a page of results"
+        keys = search(project.key(), text)
+        start = (page - 1) * settings.SEARCH_PAGE_SIZE
+        shown = keys[start:start + settings.SEARCH_PAGE_SIZE]
+        issues = [issue for issue in db.get([IssueSummary.key_for(key) for key in shown]) if issue]
+        context = {
+            'project': project,
+            'q': text,
+            'issues': issues,
+            'result_count': len(keys),
+            'page': page,
+            'previous_page': page > 1 and page - 1,
+            'next_page': len(keys) > start + len(shown) and page + 1,
+        }
+        return response_entry(self.render("search.html", context, anonymous=True))
+
+class ProjectSuggestJsonHandler(BaseRequest):
+    "Existing issues with names like the one being typed, for the add issue form"
+    cache_policy = "suggest"
+
+    def get(self, slug):
+        # answered from a prefix index held in memory, without
+        # touching the datastore once it's been loaded
+        found = suggest(slug, self.request.get("q"))
+        if found is None:
+            self.render_404()
+            return
+        json = [{
+            'name': name,
+            'internal_url': "%s/projects%s" % (settings.SYSTEM_URL, url),
+        } for url, name in found]
+        self.write_entry(response_entry(simplejson.dumps(json)),
+            "application/javascript; charset=utf8")
+
 class ProjectRssHandler(BaseRequest):
     "Project as RSS, specifically lists issues"
+    cache_policy = "feed"
+
     def get(self, slug):
 
-        output = get_cache("project_%s_rss" % slug)
-        if output is None:
-
-            project = Project.all().filter('slug =', slug).fetch(1)[0]        
-               
-            # allow query string arguments to specify filters
-            if self.request.get("open"):
-                status_filter = True
-                fixed = False
-            elif self.request.get("closed"):
-                status_filter = True
-                fixed = True
-            else:
-                status_filter = None
+        # allow query string arguments to specify filters
+        if self.request.get("open"):
+            fixed = False
+            variant = "open"
+        elif self.request.get("closed"):
+            fixed = True
+            variant = "closed"
+        else:
+            fixed = None
+            variant = "all"
+
+        # each filtered feed is cached separately
+        entry = cached("project_%s_rss_%s" % (slug, variant),
+            lambda: self._rss(slug, fixed), depends=[project_dependency(slug)],
+            refresh=settings.FEED_REFRESH_TIME)
+        if entry is None:
+            self.render_404()
+            return
+        # send the correct headers
+        self.write_entry(entry, "application/rss+xml; charset=utf8")
+
+    def _rss(self, slug, fixed):
+        "Build the feed for a project, or return None if there isn't one"
+        project = get_project(slug)
+        if project is None:
+            return None
 
-            # if we have a filter then filter the results set
-            if status_filter:
-                issues = Issue.all().filter('project =', project).filter('fixed =', fixed).order('fixed').order('created_date')
+        # if we have a filter then filter the results set
+        if fixed is not None:
+            issues = IssueSummary.all().filter('project =', project).filter('fixed =', fixed).order('fixed').order('created_date')
+        else:
+            issues = IssueSummary.all().filter('project =', project).order('fixed').order('created_date')
+        
+        # create the RSS feed
+        rss = RSS2(
+            title="Issues for %s on GitBug" % project.name,
+            link="%s/%s/" % (settings.SYSTEM_URL, project.slug),
+            description="",
+            lastBuildDate=datetime.now()
+        )
+
+        # add an item for each issue
+        for issue in issues:
+            if issue.fixed: 
+                pubDate = issue.fixed_date
+                title = "%s (%s)" % (issue.name, "Fixed")
             else:
-                issues = Issue.all().filter('project =', project).order('fixed').order('created_date')
+                pubDate = issue.created_date
+                title = issue.name
             
-            # create the RSS feed
-            rss = RSS2(
-                title="Issues for %s on GitBug" % project.name,
-                link="%s/%s/" % (settings.SYSTEM_URL, project.slug),
-                description="",
-                lastBuildDate=datetime.now()
-            )
-
-            # add an item for each issue
-            for issue in issues:
-                if issue.fixed: 
-                    pubDate = issue.fixed_date
-                    title = "%s (%s)" % (issue.name, "Fixed")
-                else:
-                    pubDate = issue.created_date
-                    title = issue.name
-                
-                rss.items.append(
-                    RSSItem(
-                        title=title,
-                        link="%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
-                        description=issue.html,
-                        pubDate=pubDate
-                    ))
-
-            # get the xml
-            output = rss.to_xml()
+            rss.items.append(
+                RSSItem(
+                    title=title,
+                    link="%s/projects%s" % (settings.SYSTEM_URL, issue.internal_url),
+                    description=issue.excerpt,
+                    pubDate=pubDate
+                ))
 
-            memcache.add("project_%s_rss" % slug, output, 3600)
-        # send the correct headers
-        self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
-        self.response.out.write(output)
+        # get the xml
+        return response_entry(rss.to_xml())
 
 class ProjectDeleteHandler(BaseRequest):
     "Delete projects, including a confirmation page"
@@ -243,7 +365,10 @@ class ProjectDeleteHandler(BaseRequest):
             self.redirect("%s/" % self.request.path, True)
             return
                         
-        project = Project.all().filter('slug =', slug).fetch(1)[0]
+        project = get_project(slug)
+        if project is None:
+            self.render_404()
+            return
         
         # if we don't have a user then throw
         # an unauthorised error
@@ -271,7 +396,10 @@ class ProjectDeleteHandler(BaseRequest):
             self.render_403()
             return
 
-        project = Project.all().filter('slug =', slug).fetch(1)[0]
+        project = get_project(slug)
+        if project is None:
+            self.render_404()
+            return
 
         user = users.get_current_user()
         if project.user == user or users.is_current_user_admin():      
@@ -293,9 +421,8 @@ class ProjectSettingsHandler(BaseRequest):
             self.redirect("%s/" % self.request.path, True)
             return
 
-        try:
-            project = Project.all().filter('slug =', slug).fetch(1)[0]
-        except IndexError:
+        project = get_project(slug)
+        if project is None:
             self.render_404()
             return
 
@@ -327,7 +454,10 @@ class ProjectSettingsHandler(BaseRequest):
 
         user = users.get_current_user()            
 
-        project = Project.all().filter('slug =', slug).fetch(1)[0]
+        project = get_project(slug)
+        if project is None:
+            self.render_404()
+            return
 
         if project.user == user:
             try:
@@ -359,48 +489,65 @@ class ProjectSettingsHandler(BaseRequest):
         self.redirect('/projects/%s/settings/' % project.slug)
 
 class IssueHandler(BaseRequest):
+    cache_policy = "issue"
+
     def get(self, project_slug, issue_slug):
         if self.request.path[-1] != "/":
             self.redirect("%s/" % self.request.path, True)
             return
             
-        user = users.get_current_user()
-        
-        output = None
-        if not user:
-            output = get_cache("/%s/%s/" % (project_slug, issue_slug))
-                    
-        if output is None:
-            try:
-                issue = Issue.all().filter('internal_url =', "/%s/%s/" % (project_slug, issue_slug)).fetch(1)[0]
-                issues = Issue.all().filter('project =', issue.project).filter('fixed =', False).fetch(10)
-            except IndexError:
-                self.render_404()
-                return
-
-            on_list = False
-            try:
-                if user.email() in issue.project.other_users:
-                    on_list = True
-            except:
-                pass
+        # everyone shares the page cached for logged out users
+        internal_url = "/%s/%s/" % (project_slug, issue_slug)
+        entry = cached(internal_url, lambda: self._render(project_slug, issue_slug),
+            depends=[project_dependency(project_slug)])
+        if entry is None:
+            self.render_404()
+            return
 
-            if issue.project.user == user or users.is_current_user_admin() or on_list:
-                owner = True
-            else:
-                owner = False
+        user = users.get_current_user()
+        if user:
+            # fill in the parts which depend on who is looking
+            issue = get_issue(project_slug, issue_slug)
             context = {
                 'issue': issue,
-                'issues': issues,
-                'owner': owner,
+                'owner': self._is_owner(issue, user),
             }
-            # calculate the template path
-            output = self.render("issue.html", context)
+            self.write_personal(entry, context)
+        else:
+            self.write_entry(entry)
 
-        if not user:
-            memcache.add("/%s/%s/" % (project_slug, issue_slug), output, 60)   
+    def _is_owner(self, issue, user):
+        "Check if the user owns the project or is on its list of users"
+        on_list = False
+        try:
+            if user.email() in issue.project.other_users:
+                on_list = True
+        except:
+            pass
+
+        return issue.project.user == user or users.is_current_user_admin() or on_list
+
+    def _render(self, project_slug, issue_slug):
+        "Render the shared issue page, or return None if there isn't one"
+        # the project's key comes from the url, so the other open
+        # issues can be fetched at the same time as the issue itself
+        project = project_key(project_slug)
+        others = fetch_async(IssueSummary.all().filter('project =', project).filter('fixed =', False), 10)
+        issue = get_issue(project_slug, issue_slug)
+        if issue is None:
+            return None
+        if Issue.project.get_value_for_datastore(issue) == project:
+            issues = others.get_result()
+        else:
+            # a project which hasn't been migrated and wasn't remembered yet
+            issues = IssueSummary.all().filter('project =', issue.project).filter('fixed =', False).fetch(10)
 
-        self.response.out.write(output)
+        context = {
+            'issue': issue,
+            'issues': issues,
+            'owner': False,
+        }
+        return response_entry(self.render("issue.html", context, anonymous=True))
     
     def post(self, project_slug, issue_slug):
         
@@ -411,7 +558,10 @@ class IssueHandler(BaseRequest):
             self.render_403()
             return
         
-        issue = Issue.all().filter('internal_url =', "/%s/%s/" % (project_slug, issue_slug)).fetch(1)[0]
+        issue = get_issue(project_slug, issue_slug)
+        if issue is None:
+            self.render_404()
+            return
         
         user = users.get_current_user()
         
@@ -445,37 +595,44 @@ class IssueHandler(BaseRequest):
         self.redirect("/projects%s" % issue.internal_url)
 
 class IssueJsonHandler(BaseRequest):
-    def get(self, project_slug, issue_slug):
-
-        output = get_cache("/%s/%s.json" % (project_slug, issue_slug))
+    cache_policy = "json"
 
-        if output is None:
-            issue = Issue.all().filter('internal_url =', "/%s/%s/" % (project_slug, issue_slug)).fetch(1)[0]
+    def get(self, project_slug, issue_slug):
 
-            if issue.fixed: 
-                status = "Fixed"
-            else:
-                status = "Open"
+        entry = cached("/%s/%s.json" % (project_slug, issue_slug),
+            lambda: self._json(project_slug, issue_slug),
+            depends=[project_dependency(project_slug)], refresh=settings.JSON_REFRESH_TIME)
+        if entry is None:
+            self.render_404()
+            return
+        self.write_entry(entry, "application/javascript; charset=utf8")
 
-            json = {
-                'date': str(datetime.now())[0:19],
-                'name': issue.name,
-                'project': issue.project.name,
-                'project_url': "%s/projects/%s" % (settings.SYSTEM_URL, issue.project.slug),
-                'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, issue.internal_url),
-                'created_date': str(issue.created_date)[0:19],
-                'description': issue.html,
-                'status': status,
-                'identifier': "#gitbug%s" % issue.identifier,
-            }
-            if issue.fixed and issue.fixed_description:
-                json['fixed_description'] = issue.fixed_description
+    def _json(self, project_slug, issue_slug):
+        "Build the JSON for an issue, or return None if there isn't one"
+        issue = get_issue(project_slug, issue_slug)
+        if issue is None:
+            return None
 
-            output = simplejson.dumps(json)
+        if issue.fixed: 
+            status = "Fixed"
+        else:
+            status = "Open"
+
+        json = {
+            'date': str(datetime.now())[0:19],
+            'name': issue.name,
+            'project': issue.project.name,
+            'project_url': "%s/projects/%s" % (settings.SYSTEM_URL, issue.project.slug),
+            'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, issue.internal_url),
+            'created_date': str(issue.created_date)[0:19],
+            'description': issue.html,
+            'status': status,
+            'identifier': "#gitbug%s" % issue.identifier,
+        }
+        if issue.fixed and issue.fixed_description:
+            json['fixed_description'] = issue.fixed_description
 
-            memcache.add("/%s/%s.json" % (project_slug, issue_slug), output, 3600)   
-        self.response.headers["Content-Type"] = "application/javascript; charset=utf8"
-        self.response.out.write(output)
+        return response_entry(simplejson.dumps(json))
         
 class IssueDeleteHandler(BaseRequest):
     def get(self, project_slug, issue_slug):
@@ -491,7 +648,10 @@ class IssueDeleteHandler(BaseRequest):
             self.render_403()
             return
             
-        issue = Issue.all().filter('internal_url =', "/%s/%s/" % (project_slug, issue_slug)).fetch(1)[0]        
+        issue = get_issue(project_slug, issue_slug)
+        if issue is None:
+            self.render_404()
+            return
             
         if issue.project.user == user or users.is_current_user_admin():
             context = {
@@ -513,7 +673,10 @@ class IssueDeleteHandler(BaseRequest):
             self.render_403()
             return
 
-        issue = Issue.all().filter('internal_url =', "/%s/%s/" % (project_slug, issue_slug)).fetch(1)[0]        
+        issue = get_issue(project_slug, issue_slug)
+        if issue is None:
+            self.render_404()
+            return
 
         user = users.get_current_user()
         if issue.project.user == user:
@@ -528,25 +691,43 @@ class IssueDeleteHandler(BaseRequest):
             return
 
 class ProjectsHandler(BaseRequest):
+    cache_policy = "projects"
+
     def get(self):
         if self.request.path[-1] != "/":
             self.redirect("%s/" % self.request.path, True)
             return
         
-        user = users.get_current_user()
-        output = None
-        if not user:
-            output = get_cache("projects")
-        if output is None:
-            projects = Project.all().order('-created_date').fetch(50)
-            context = {
-                'projects': projects,
-            }
-            # calculate the template path
-            output = self.render("projects.html", context)
-            if not user:
-                memcache.add("projects", output, 3600)
-        self.response.out.write(output)
+        # everyone shares the page cached for logged out users,
+        # with each page of projects cached separately
+        cursor = self.request.get("cursor")
+        entry = cached(page_key("projects", cursor), lambda: self._render(cursor),
+            depends=[PROJECTS_DEPENDENCY])
+        if entry is None:
+            self.render_404()
+            return
+        if users.get_current_user():
+            self.write_personal(entry)
+        else:
+            self.write_entry(entry)
+
+    def _render(self, cursor=None):
+        """
+        Render a page of the latest projects starting at the cursor,
+        or return None if the cursor isn't valid
+        """
+        page = fetch_page(Project.all().order('-created_date'), cursor,
+            settings.PROJECTS_PAGE_SIZE)
+        if page is None:
+            return None
+        projects, next_cursor = page
+        context = {
+            'projects': projects,
+            'cursor': cursor,
+            'next_cursor': next_cursor,
+        }
+        # calculate the template path
+        return response_entry(self.render("projects.html", context, anonymous=True))
 
     def post(self):
         
@@ -565,7 +746,7 @@ class ProjectsHandler(BaseRequest):
             if name.strip():
                 if Project.all().filter('name =', name).count() == 0:
                     # we also need to check if we have something with the same slug
-                    if Project.all().filter('slug =', slugify(unicode(name))).count() == 0:
+                    if get_project(slugify(unicode(name))) is None:
                         try:
                             project = Project(
                                 name=name,
@@ -573,86 +754,172 @@ class ProjectsHandler(BaseRequest):
                             )
                             project.put()
                             logging.info("project added: %s" % project.name)
+                        except DuplicateProject:
+                            logging.info("project already exists: %s" % name)
                         except db.BadValueError, e:
                             logging.error("error adding project: %s" % e)
         self.redirect('/')
         
 class ProjectsJsonHandler(BaseRequest):
+        cache_policy = "json"
+
         def get(self):
-            output = get_cache("projects_json")
-            if output is None:
-                projects = Project.all().order('-created_date').fetch(50)
-                projects_data = {}
-
-                for project in projects:
-                    data = {
-                        'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
-                        'created_date': str(project.created_date)[0:19],
-                        'open_issues': project.open_issues.count(),
-                        'closed_issues': project.closed_issues.count(),
-                    }
-                    if project.url:
-                        data['external_url'] = project.url
-                    projects_data[project.name] = data
-
-                json = {
-                    'date': str(datetime.now())[0:19],
-                    'projects': projects_data,
+            cursor = self.request.get("cursor")
+            entry = cached(page_key("projects_json", cursor), lambda: self._json(cursor),
+                depends=[PROJECTS_DEPENDENCY], refresh=settings.JSON_REFRESH_TIME)
+            if entry is None:
+                self.render_404()
+                return
+            self.write_entry(entry, "application/javascript; charset=utf8")
+
+        def _json(self, cursor=None):
+            """
+            Build the JSON for a page of the latest projects starting at
+            the cursor, or return None if the cursor isn't valid
+            """
+            page = fetch_page(Project.all().order('-created_date'), cursor,
+                settings.PROJECTS_PAGE_SIZE)
+            if page is None:
+                return None
+            projects, next_cursor = page
+            projects_data = {}
+
+            for project in projects:
+                data = {
+                    'internal_url': "%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
+                    'created_date': str(project.created_date)[0:19],
+                    'open_issues': project.open_count,
+                    'closed_issues': project.closed_count,
                 }
+                if project.url:
+                    data['external_url'] = project.url
+                projects_data[project.name] = data
 
-                output = simplejson.dumps(json)            
-                memcache.add("projects_json", output, 3600)
-            self.response.headers["Content-Type"] = "application/javascript; charset=utf8"
-            self.response.out.write(output)
+            json = {
+                'date': str(datetime.now())[0:19],
+                'projects': projects_data,
+            }
+            if next_cursor:
+                json['next_url'] = "%s/projects.json?cursor=%s" % (settings.SYSTEM_URL,
+                    urllib.quote(next_cursor))
+
+            return response_entry(simplejson.dumps(json))
+
+class SearchJsonHandler(BaseRequest):
+    "Search the issues of every project the current user owns or works on, as JSON"
+    cache_policy = "search"
+
+    def get(self):
+        user = users.get_current_user()
+        if not user:
+            self.render_403()
+            return
+        text = self.request.get("q")
+
+        # find the projects this user can see while finding the others
+        owned, shared = wait(
+            fetch_async(Project.all(keys_only=True).filter('user =', user)),
+            fetch_async(Project.all(keys_only=True).filter('other_users =', user.email())))
+        visible = dict([(str(key), key) for key in owned + shared])
+
+        # users who can see the same projects share results for the same words
+        results = search_visible(visible.values(), text)
+        # the cursor is the last result of the previous page
+        try:
+            remaining = results_after(results, self.request.get("cursor"))
+        except ValueError:
+            self.render_404()
+            return
+
+        page = remaining[:settings.SEARCH_PAGE_SIZE]
+        summaries = db.get([IssueSummary.key_for(db.Key(issue)) for score, issue in page])
+        issues = []
+        for (score, issue), summary in zip(page, summaries):
+            # deleted since the results were cached
+            if summary is None:
+                continue
+            issues.append({
+                'name': summary.name,
+                'identifier': summary.identifier,
+                'project': summary.internal_url.strip('/').split('/')[0],
+                'internal_url': "%s/projects%s" % (settings.SYSTEM_URL, summary.internal_url),
+                'created_date': str(summary.created_date)[0:19],
+                'fixed': summary.fixed,
+                'score': score,
+            })
+
+        json = {
+            'date': str(datetime.now())[0:19],
+            'query': text,
+            'total': len(results),
+            'issues': issues,
+        }
+        if len(page) < len(remaining):
+            json['next_url'] = "%s/search.json?q=%s&cursor=%s" % (settings.SYSTEM_URL,
+                urllib.quote(text.encode('utf8')), urllib.quote(result_cursor(page[-1])))
+        self.write_entry(response_entry(simplejson.dumps(json)),
+            "application/javascript; charset=utf8")
 
 class ProjectsRssHandler(BaseRequest):
+        cache_policy = "feed"
+
         def get(self):
-            output = get_cache("projects_rss")
-            if output is None:
-                
-                projects = Project.all().order('-created_date').fetch(20)
-                rss = RSS2(
-                    title="GitBug projects",
-                    link="%s" % settings.SYSTEM_URL,
-                    description="A list of the latest 20 projects on GitBug",
-                    lastBuildDate=datetime.now()
-                )
+            entry = cached("projects_rss", self._rss, depends=[PROJECTS_DEPENDENCY],
+                refresh=settings.FEED_REFRESH_TIME)
+            self.write_entry(entry, "application/rss+xml; charset=utf8")
 
-                for project in projects:
-                    rss.items.append(
-                        RSSItem(
-                            title=project.name,
-                            link="%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
-                            description="",
-                            pubDate=project.created_date
-                        ))
+        def _rss(self):
+            "Build the feed of the latest projects"
+            projects = Project.all().order('-created_date').fetch(20)
+            rss = RSS2(
+                title="GitBug projects",
+                link="%s" % settings.SYSTEM_URL,
+                description="A list of the latest 20 projects on GitBug",
+                lastBuildDate=datetime.now()
+            )
 
-                output = rss.to_xml()
+            for project in projects:
+                rss.items.append(
+                    RSSItem(
+                        title=project.name,
+                        link="%s/projects/%s/" % (settings.SYSTEM_URL, project.slug),
+                        description="",
+                        pubDate=project.created_date
+                    ))
 
-                memcache.add("projects_rss", output, 3600)
-            self.response.headers["Content-Type"] = "application/rss+xml; charset=utf8"
-            self.response.out.write(output)
+            return response_entry(rss.to_xml())
 
 class WebHookHandler(BaseRequest):
     def post(self, slug):
-        project = Project.all().filter('slug =', slug).fetch(1)[0]
+        project = get_project(slug)
+        if project is None:
+            self.render_404()
+            return
         
         key = self.request.get("key")
         
-        if key == project.key(): 
+        # hooks set up before the project was migrated use its old key
+        if key and key in (str(project.key()), project.legacy_key): 
             try:
                 payload = self.request.get("payload")
                 representation = simplejson.loads(payload)
                 commits = representation['commits']
+                identifiers = []
                 for commit in commits:
                     message = commit['message']
                     search = GITBUG.search(message)
                     if search:
-                        identifier = search.group()[7:]                                
-                        issue = Issue.all().filter('project =', project).filter('identifier =', int(identifier)).fetch(1)[0]
-                        issue.fixed = True
-                        issue.put()
-                        logging.info("issue updated via webhook: %s in %s" % (issue.name, issue.project.name))
+                        identifiers.append(int(search.group()[7:]))
+                # fetch every mentioned issue at once rather than one by one
+                issues = get_issues_by_identifier(project, identifiers)
+                for identifier in identifiers:
+                    issue = issues.get(identifier)
+                    if issue is None:
+                        logging.info("webhook unknown issue: %s in %s" % (identifier, project.name))
+                        continue
+                    issue.fixed = True
+                    issue.put()
+                    logging.info("issue updated via webhook: %s in %s" % (issue.name, issue.project.name))
             except Exception, e:
                 logging.error("webhook error: %s" % e)
         else:
@@ -663,31 +930,26 @@ class WebHookHandler(BaseRequest):
 class NotFoundPageHandler(BaseRequest):
     def get(self):
         self.error(404)
-        user = users.get_current_user()
-        output = None
-        if not user:
-            output = get_cache("error404")
-        if output is None:        
+        if users.get_current_user():
             output = self.render("404.html")
-            if not user:
-                memcache.add("error404", output, 3600)
+        else:
+            output = cached("error404", lambda: self.render("404.html"))
         self.response.out.write(output)
         
 class FaqPageHandler(BaseRequest):
+    cache_policy = "faq"
+
     def get(self):
         if self.request.path[-1] != "/":
             self.redirect("%s/" % self.request.path, True)
             return
             
-        user = users.get_current_user()
-        output = None
-        if not user:
-            output = get_cache("faq")
-        if output is None:        
-            output = self.render("faq.html")
-            if not user:
-                memcache.add("faq", output, 3600)
-        self.response.out.write(output)
+        # everyone shares the page cached for logged out users
+        entry = cached("faq", lambda: response_entry(self.render("faq.html", anonymous=True)))
+        if users.get_current_user():
+            self.write_personal(entry)
+        else:
+            self.write_entry(entry)
                         
 def application():
     "Run the application"
@@ -696,10 +958,13 @@ def application():
         ('/', Index),
         ('/projects.json$', ProjectsJsonHandler),
         ('/projects.rss$', ProjectsRssHandler),
+        ('/search.json$', SearchJsonHandler),
         ('/projects/?$', ProjectsHandler),
         ('/projects/([A-Za-z0-9-]+)/hook/?$', WebHookHandler),
         ('/projects/([A-Za-z0-9-]+)/delete/?$', ProjectDeleteHandler),
         ('/projects/([A-Za-z0-9-]+)/settings/?$', ProjectSettingsHandler),
+        ('/projects/([A-Za-z0-9-]+)/search/?$', ProjectSearchHandler),
+        ('/projects/([A-Za-z0-9-]+)/suggest.json$', ProjectSuggestJsonHandler),
         ('/projects/([A-Za-z0-9-]+)/([A-Za-z0-9-]+).json$', IssueJsonHandler),
         ('/projects/([A-Za-z0-9-]+)/([A-Za-z0-9-]+)/?$', IssueHandler),
         ('/projects/([A-Za-z0-9-]+)/([A-Za-z0-9-]+)/delete/?$', IssueDeleteHandler),
@@ -1,12 +1,94 @@
-from datetime import datetime
+import logging
+import threading
+from datetime import datetime, timedelta
 
 from google.appengine.ext import db
-from google.appengine.ext import search
 from google.appengine.api import mail
+from django.utils.html import strip_tags
+from django.utils.text import truncate_words
 
-from lib import slugify, textile
+from lib import slugify, textile, invalidate_cache, get_cache, set_cache, delete_cache
+from lib import IDENTITY_MAP
+from tasks import queue_project_deletion, queue_index
+from rpc import count_async, wait
+from fulltext import SearchDocument, IndexPending, document_for, pending_for, search_dependency
+from suggest import SuggestIndex, update_suggestions, suggest_dependency
 import settings
 
+# cached pages listing projects, such as the projects page and feeds
+PROJECTS_DEPENDENCY = "projects"
+
+def project_dependency(slug):
+    """
+    Name of the cache dependency for pages built from a project, which
+    includes the pages for all of the issues in that project
+    """
+    return "project_%s" % slug
+
+def get_entities(keys):
+    """
+    Get entities by key as a dictionary, using any already fetched in this
+    request and fetching the rest with a single batch get
+    """
+    entities = {}
+    missing = []
+    for key in keys:
+        entity = IDENTITY_MAP.get(key)
+        if entity is None:
+            missing.append(key)
+        else:
+            entities[key] = entity
+    if missing:
+        for entity in db.get(missing):
+            if entity is not None:
+                IDENTITY_MAP.add(entity)
+                entities[entity.key()] = entity
+    return entities
+
+def fetch_page(query, cursor, size):
+    """
+    Fetch a page of results from a query, starting from the cursor given
+    by the page before. Returns the results and the cursor for the next
+    page, which is None on the last page, or None if the cursor is invalid
+    """
+    if cursor:
+        try:
+            query.with_cursor(cursor)
+        except (db.BadValueError, db.BadRequestError):
+            return None
+    results = query.fetch(size)
+    next_cursor = None
+    if len(results) == size:
+        next_cursor = query.cursor()
+    return results, next_cursor
+
+def prefetch_references(entities, *names):
+    """
+    Resolve the reference properties on a list of entities with one batch
+    get, so using them afterwards doesn't fetch each one in turn. Every
+    reference property is resolved unless property names are given
+    """
+    entities = [entity for entity in entities if entity is not None]
+    references = []
+    for entity in entities:
+        for name, prop in entity.properties().items():
+            if isinstance(prop, db.ReferenceProperty) and (not names or name in names):
+                key = prop.get_value_for_datastore(entity)
+                if key is not None:
+                    references.append((entity, prop, key))
+    fetched = get_entities(set([key for entity, prop, key in references]))
+    for entity, prop, key in references:
+        if key in fetched:
+            prop.__set__(entity, fetched[key])
+    return entities
+
+# slug to key for projects found by query because they were saved
+# before projects were stored under a key name made from the slug
+PROJECT_KEYS = {}
+
+class DuplicateProject(Exception):
+    "Raised when saving a new project whose slug is already taken"
+
 class Project(db.Model):
     "Represents a single project"
     name = db.StringProperty(required=True)
@@ -15,8 +97,29 @@ class Project(db.Model):
     html = db.TextProperty()
     slug = db.StringProperty()
     created_date = db.DateTimeProperty(auto_now_add=True)
+    # when the project or its issue counts last changed
+    modified_date = db.DateTimeProperty()
     user = db.UserProperty(required=True)
     other_users = db.StringListProperty()
+    # kept up to date by Issue.put and Issue.delete so listing
+    # projects doesn't need to count issues
+    open_count = db.IntegerProperty(default=0)
+    closed_count = db.IntegerProperty(default=0)
+    # key of the entity this project was migrated from, still
+    # accepted by the webhook so existing hook urls keep working
+    legacy_key = db.StringProperty()
+
+    # make it easy to retrieve the object based on slug
+    key_template = 'project/%(slug)s'
+
+    def __init__(self, *args, **kwargs):
+        # new projects are stored under a key name made from the slug
+        # so they can be fetched without a query
+        if not kwargs.get('_from_entity') and not 'key' in kwargs \
+                and not 'key_name' in kwargs and kwargs.get('name'):
+            slug = kwargs.get('slug') or slugify(unicode(kwargs['name']))
+            kwargs['key_name'] = Project.key_template % {'slug': slug}
+        super(Project, self).__init__(*args, **kwargs)
 
     @property
     def open_issues(self):
@@ -34,7 +137,177 @@ class Project(db.Model):
         self.html = textile(unicode(self.description))
         if not self.slug:
             self.slug = slugify(unicode(self.name))
-        super(Project, self).put()
+        self.modified_date = datetime.now()
+        if not self.is_saved() and self.has_key():
+            # two people can add projects whose names give the same slug
+            # at once, so check for it and save in one transaction rather
+            # than one taking over the other
+            def insert():
+                if db.get(self.key()) is not None:
+                    return None
+                return super(Project, self).put()
+            key = db.run_in_transaction(insert)
+            if key is None:
+                raise DuplicateProject(self.slug)
+        elif self.is_saved():
+            # the issue counts may have changed since this copy was read,
+            # so save it with the latest ones rather than writing them back
+            def save():
+                stored = Project.get(self.key())
+                if stored is not None:
+                    self.open_count = stored.open_count
+                    self.closed_count = stored.closed_count
+                return super(Project, self).put()
+            key = db.run_in_transaction(save)
+        else:
+            key = super(Project, self).put()
+        self.clear_cache()
+        return key
+
+    def touch(self, opened=0, closed=0):
+        """
+        Record that something shown on the project pages has changed,
+        adding to the open and closed issue counts at the same time. The
+        project is only saved when a count changes, so editing issues
+        doesn't queue up behind other writes to the project
+        """
+        if not opened and not closed:
+            self.clear_cache()
+            return
+        def update():
+            project = Project.get(self.key())
+            project.open_count = (project.open_count or 0) + opened
+            project.closed_count = (project.closed_count or 0) + closed
+            project.modified_date = datetime.now()
+            # skip the processing in put as the project itself is unchanged
+            super(Project, project).put()
+            return project
+        project = db.run_in_transaction(update)
+        # keep this copy in step with the datastore
+        self.open_count = project.open_count
+        self.closed_count = project.closed_count
+        self.modified_date = project.modified_date
+        self.clear_cache()
+
+    def repair_counts(self):
+        "Count the open and closed issues again, in case the totals have drifted"
+        open_count, closed_count = wait(
+            count_async(Issue.all(keys_only=True).filter('project =', self).filter('fixed =', False)),
+            count_async(Issue.all(keys_only=True).filter('project =', self).filter('fixed =', True)),
+        )
+        def update():
+            project = Project.get(self.key())
+            project.open_count = open_count
+            project.closed_count = closed_count
+            super(Project, project).put()
+        db.run_in_transaction(update)
+        self.open_count = open_count
+        self.closed_count = closed_count
+        self.clear_cache()
+
+    def delete(self):
+        """
+        Overridden delete method which clears any cached pages and
+        starts removing the project's issues in the background
+        """
+        deletion = ProjectDeletion(
+            project_key=str(self.key()),
+            slug=self.slug,
+            name=self.name,
+        )
+        deletion.put()
+        # a new project could take the slug, so its suggestions go now
+        db.delete(SuggestIndex.key_for(self.slug))
+        invalidate_cache(suggest_dependency(self.slug))
+        self._remove()
+        try:
+            queue_project_deletion(deletion)
+        except Exception, e:
+            # the project has gone by now, and an unfinished deletion is
+            # queued again later by the requeue job, so don't fail
+            logging.error("error queueing deletion of %s: %s" % (self.slug, e))
+
+    def _remove(self):
+        "Delete just the project itself"
+        super(Project, self).delete()
+        IDENTITY_MAP.delete(self.key())
+        forget_project_key(self.slug)
+        self.clear_cache()
+
+    def migrate(self):
+        """
+        Move a project saved before key names were used to an entity
+        stored under its slug, pointing its issues and counter at the
+        new entity. Returns the new project, or this one if already moved
+        """
+        key_name = Project.key_template % {'slug': self.slug}
+        if self.key().name() == key_name:
+            return self
+        values = dict((name, getattr(self, name)) for name in self.properties())
+        values['legacy_key'] = str(self.key())
+        project = Project(key_name=key_name, **values)
+        # save directly so the modified date and cached pages are left alone
+        db.put(project)
+
+        # saved directly too, as the issues themselves haven't changed
+        for model in (Issue, IssueSummary, SearchDocument):
+            entities = model.all().filter('project =', self).order('__key__').fetch(100)
+            while entities:
+                for entity in entities:
+                    entity.project = project
+                db.put(entities)
+                entities = model.all().filter('project =', self).filter(
+                    '__key__ >', entities[-1].key()).order('__key__').fetch(100)
+        counter = Counter.get_by_key_name(Counter.key_template % {'project': self.name})
+        if counter:
+            counter.project = project
+            counter.put()
+
+        # the issues have moved so only the old project itself goes
+        self._remove()
+        project.clear_cache()
+        return project
+
+    def clear_cache(self):
+        "Clear the cached pages which show this project"
+        invalidate_cache(project_dependency(self.slug), PROJECTS_DEPENDENCY)
+
+def project_key(slug):
+    "Work out the datastore key of a project from its slug"
+    key = PROJECT_KEYS.get(slug)
+    if key is None:
+        key = get_cache("project_key_%s" % slug)
+        if key is not None:
+            PROJECT_KEYS[slug] = key
+    if key is None:
+        return db.Key.from_path('Project', Project.key_template % {'slug': slug})
+    return db.Key(key)
+
+def forget_project_key(slug):
+    "Drop a remembered project key which is no longer right"
+    PROJECT_KEYS.pop(slug, None)
+    delete_cache("project_key_%s" % slug)
+
+def get_project(slug):
+    """
+    Get a project by its slug, or None if there isn't one. Usually a
+    single get, but projects which haven't been migrated to a key name
+    are found with a query once and their key remembered afterwards
+    """
+    key = project_key(slug)
+    project = get_entities([key]).get(key)
+    if project is None:
+        if key.name() is None:
+            # the project has been migrated or deleted since we remembered it
+            forget_project_key(slug)
+        project = Project.all().filter('slug =', slug).get()
+        if project is None:
+            return None
+        IDENTITY_MAP.add(project)
+        if project.key().name() is None:
+            PROJECT_KEYS[slug] = str(project.key())
+            set_cache("project_key_%s" % slug, str(project.key()))
+    return project
 
 class Counter(db.Model):
     "Project specific counter"
@@ -44,12 +317,83 @@ class Counter(db.Model):
     # make it easy to retrieve the object based on key
     key_template = 'counter/%(project)s'
 
-class Issue(search.SearchableModel):
+class IdentifierAllocator(object):
+    """
+    Hands out per project issue identifiers. Rather than updating the
+    project's counter for every issue, each instance reserves a block of
+    identifiers in one transaction and then uses them up from memory.
+    Identifiers are always unique, but are only in order within a block
+    and any left in a block when an instance stops are never used.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        # guards the dictionary of locks, each of which guards one project
+        self.lock = threading.Lock()
+        self.locks = {}
+        # project to [next identifier, last identifier] for this instance
+        self.blocks = {}
+
+    def lock_for(self, key):
+        "The lock held while allocating in a project"
+        self.lock.acquire()
+        try:
+            return self.locks.setdefault(key, threading.Lock())
+        finally:
+            self.lock.release()
+
+    def allocate(self, project):
+        """
+        Get the next unused identifier for an issue in a project. Blocks
+        are kept by when the project was created as well as its key, so a
+        project deleted and created again with the same slug starts afresh
+        """
+        key = (str(project.key()), project.created_date)
+        lock = self.lock_for(key)
+        lock.acquire()
+        try:
+            block = self.blocks.get(key)
+            if block is None or block[0] > block[1]:
+                block = self.reserve(project)
+                self.blocks[key] = block
+            identifier = block[0]
+            block[0] += 1
+            return identifier
+        finally:
+            lock.release()
+
+    def reserve(self, project):
+        "Move the project's counter on by a block, returning the range reserved"
+        key_name = Counter.key_template % {'project': project.name}
+        def update():
+            counter = Counter.get_by_key_name(key_name)
+            if counter is None:
+                # if it's the first issue we need to create the counter
+                counter = Counter(
+                    key_name=key_name,
+                    project=project,
+                    count=0,
+                )
+            first = counter.count + 1
+            counter.count += self.block_size
+            counter.put()
+            return first
+        first = db.run_in_transaction(update)
+        return [first, first + self.block_size - 1]
+
+# shared by every request served by this instance
+IDENTIFIERS = IdentifierAllocator(settings.IDENTIFIER_BLOCK_SIZE)
+
+class DuplicateIssue(Exception):
+    "Raised when saving a new issue whose url is already taken"
+
+class Issue(db.Model):
     "Issue or bug representation"
     name = db.StringProperty(required=True)
     description = db.TextProperty()
     html = db.TextProperty()
     created_date = db.DateTimeProperty(auto_now_add=True)
+    modified_date = db.DateTimeProperty()
     email = db.EmailProperty()
     project = db.ReferenceProperty(Project, required=True)
     internal_url = db.StringProperty()
@@ -58,6 +402,30 @@ class Issue(search.SearchableModel):
     fixed_description = db.TextProperty()
     identifier = db.IntegerProperty()
 
+    # make it easy to retrieve the object based on its url
+    key_template = 'issue/%(project)s/%(slug)s'
+
+    def __init__(self, *args, **kwds):
+        # new issues are stored under a key name made from the project
+        # and issue slugs so pages can fetch them without a query
+        if not kwds.get('_from_entity') and not 'key' in kwds \
+                and not 'key_name' in kwds and kwds.get('name') \
+                and isinstance(kwds.get('project'), Project):
+            kwds['key_name'] = Issue.key_template % {
+                'project': kwds['project'].slug,
+                'slug': slugify(unicode(kwds['name'])),
+            }
+        super(Issue, self).__init__(*args, **kwds)
+        # remember whether the stored issue is fixed, so put and
+        # delete know which of the project's counts to change, and
+        # the stored text so put knows whether to index it again
+        if kwds.get('_from_entity'):
+            self._saved_fixed = self.fixed
+            self._saved_text = (self.name, self.description)
+        else:
+            self._saved_fixed = None
+            self._saved_text = None
+
     def put(self):
         "Overridden save method"
         # we save the html here as it's faster than processing 
@@ -74,20 +442,9 @@ class Issue(search.SearchableModel):
         # on an integer. This integer is stored in counter in the datastore
         # which is associated with the project
         if not self.identifier:
-            counter = Counter.get_by_key_name("counter/%s" % self.project.name)
-            if counter is None:
-                # if it's the first issue we need to create the counter
-                counter = Counter(
-                    key_name="counter/%s" % self.project.name,
-                    project=self.project,
-                    count=0,
-                )
-            # increment the count
-            counter.count += 1
-            counter.put()
-        
-            # save the count against the issue for use in the identifier
-            self.identifier = counter.count
+            self.identifier = IDENTIFIERS.allocate(self.project)
+
+        self.modified_date = datetime.now()
 
         # if the bug gets fixed then we store that date
         # if it's later marked as open we clear the date
@@ -115,4 +472,309 @@ Description: %s
 Thanks for using GitBug <http://gitbug.appspot.com>. A very simple issue tracker.
 """ % (self.name, self.description, self.fixed_description))
         
-        super(Issue, self).put()
\ No newline at end of file
+        new = self._saved_fixed is None
+        if new and self.has_key():
+            # two people can add an issue with the same name at once, so
+            # check for it and save in one transaction rather than one
+            # overwriting the other
+            def insert():
+                if db.get(self.key()) is not None:
+                    return None
+                return super(Issue, self).put()
+            key = db.run_in_transaction(insert)
+            if key is None:
+                raise DuplicateIssue(self.internal_url)
+        else:
+            key = super(Issue, self).put()
+        # keep the copy shown in lists in step, and record
+        # the identifier the first time the issue is saved
+        entities = [IssueSummary.for_issue(self)]
+        if new:
+            entities.append(IssueIdentifier.for_issue(self))
+        # only index the text again if it's changed, which is left to
+        # the queue so saving doesn't wait for it, along with bringing
+        # the project's suggestions up to date
+        reindex = (self.name, self.description) != self._saved_text
+        if reindex:
+            entities.append(pending_for(self))
+            self._saved_text = (self.name, self.description)
+        db.put(entities)
+        if reindex:
+            queue_index(self.key())
+
+        # move the issue between the project's open and closed counts
+        opened = closed = 0
+        if self._saved_fixed is None:
+            # a new issue
+            if self.fixed:
+                closed = 1
+            else:
+                opened = 1
+        elif self._saved_fixed != self.fixed:
+            if self.fixed:
+                opened, closed = -1, 1
+            else:
+                opened, closed = 1, -1
+        self._saved_fixed = self.fixed
+
+        # the project pages list issues, so they change too
+        self.project.touch(opened, closed)
+        return key
+
+    def delete(self):
+        "Overridden delete method which updates the project"
+        db.delete([
+            self.key(),
+            IssueIdentifier.key_for(self.project.slug, self.identifier),
+            IssueSummary.key_for(self.key()),
+            SearchDocument.key_for(self.key()),
+            IndexPending.key_for(self.key()),
+        ])
+        IDENTITY_MAP.delete(self.key())
+        invalidate_cache(search_dependency(self.project.key()))
+        if self.key().name():
+            # the queue removes it from suggestions once it finds it gone
+            queue_index(self.key())
+        else:
+            # issues saved before key names can't be found from their key
+            update_suggestions(self.project.slug, self.internal_url)
+        fixed = self._saved_fixed
+        if fixed is None:
+            fixed = self.fixed
+        if fixed:
+            self.project.touch(closed=-1)
+        else:
+            self.project.touch(opened=-1)
+
+    def backfill(self):
+        """
+        Move an issue saved before key names were used to an entity stored
+        under its url, recording its identifier and saving the summary used
+        in lists. Returns the issue at its
+        new key, or this one if it's already there or the key is taken
+        """
+        issue = self
+        project_slug, slug = self.internal_url.strip('/').split('/')
+        key_name = Issue.key_template % {'project': project_slug, 'slug': slug}
+        if self.key().name() is None:
+            if Issue.get_by_key_name(key_name) is None:
+                values = dict((name, getattr(self, name)) for name in self.properties())
+                issue = Issue(key_name=key_name, **values)
+                # saved directly as nothing about the issue has changed
+                db.put(issue)
+                db.delete([self.key(), IssueSummary.key_for(self.key()),
+                    SearchDocument.key_for(self.key()), IndexPending.key_for(self.key())])
+                IDENTITY_MAP.delete(self.key())
+            else:
+                logging.warning("issue key already taken: %s" % self.internal_url)
+        db.put([IssueIdentifier.for_issue(issue), IssueSummary.for_issue(issue),
+            document_for(issue)])
+        return issue
+
+class IssueIdentifier(db.Model):
+    "Maps a project's issue identifier to the issue, for the webhook"
+    issue = db.ReferenceProperty(Issue, required=True)
+
+    # make it easy to retrieve the object based on key
+    key_template = 'identifier/%(project)s/%(identifier)s'
+
+    @classmethod
+    def key_for(cls, project_slug, identifier):
+        "Key of the mapping for an identifier in a project"
+        return db.Key.from_path(cls.kind(),
+            cls.key_template % {'project': project_slug, 'identifier': identifier})
+
+    @classmethod
+    def for_issue(cls, issue):
+        "Build the mapping for an issue's identifier, ready to save"
+        key = cls.key_for(issue.project.slug, issue.identifier)
+        return cls(key_name=key.name(), issue=issue)
+
+class IssueSummary(db.Model):
+    """
+    The parts of an issue shown in lists of issues, saved alongside the
+    issue so lists don't load every description and search index
+    """
+    project = db.ReferenceProperty(Project, required=True)
+    name = db.StringProperty(required=True)
+    identifier = db.IntegerProperty()
+    internal_url = db.StringProperty()
+    # the start of the description as plain text
+    excerpt = db.StringProperty(multiline=True)
+    fixed = db.BooleanProperty(default=False)
+    created_date = db.DateTimeProperty()
+    fixed_date = db.DateTimeProperty()
+    modified_date = db.DateTimeProperty()
+
+    @classmethod
+    def key_for(cls, issue_key):
+        "Key of the summary for an issue, which shares its key name or id"
+        if issue_key.name():
+            return db.Key.from_path(cls.kind(), issue_key.name())
+        return db.Key.from_path(cls.kind(), "id/%s" % issue_key.id())
+
+    @classmethod
+    def for_issue(cls, issue):
+        "Build the summary of an issue, ready to save"
+        excerpt = truncate_words(strip_tags(issue.html or ""), 30)[:200]
+        return cls(
+            key_name=cls.key_for(issue.key()).name(),
+            project=issue.project,
+            name=issue.name,
+            identifier=issue.identifier,
+            internal_url=issue.internal_url,
+            excerpt=excerpt,
+            fixed=issue.fixed,
+            created_date=issue.created_date,
+            fixed_date=issue.fixed_date,
+            modified_date=issue.modified_date,
+        )
+
+def issue_key(project_slug, issue_slug):
+    "Work out the datastore key of an issue from its url"
+    return db.Key.from_path('Issue',
+        Issue.key_template % {'project': project_slug, 'slug': issue_slug})
+
+def get_issue(project_slug, issue_slug):
+    """
+    Get an issue by the slugs in its url, or None if there isn't one.
+    Issues which haven't been backfilled onto a key name need a query
+    """
+    key = issue_key(project_slug, issue_slug)
+    # the project is almost always wanted too, so get both together
+    issue = get_entities([key, project_key(project_slug)]).get(key)
+    if issue is None:
+        issue = Issue.all().filter('internal_url =', "/%s/%s/" % (project_slug, issue_slug)).get()
+        if issue is None:
+            return None
+        IDENTITY_MAP.add(issue)
+    # nearly everything shown with an issue comes from its project
+    prefetch_references([issue])
+    return issue
+
+def get_issues_by_identifier(project, identifiers):
+    """
+    Get the issues in a project with any of the given identifiers, as a
+    dictionary keyed by identifier, using two batch gets
+    """
+    keys = [IssueIdentifier.key_for(project.slug, identifier) for identifier in identifiers]
+    issue_keys = [IssueIdentifier.issue.get_value_for_datastore(mapping)
+        for mapping in db.get(keys) if mapping]
+    issues = {}
+    for issue in get_entities(issue_keys).values():
+        issues[issue.identifier] = issue
+    for identifier in identifiers:
+        if not identifier in issues:
+            # issues which haven't been backfilled have no mapping yet
+            issue = Issue.all().filter('project =', project).filter('identifier =', identifier).get()
+            if issue:
+                issues[identifier] = issue
+    prefetch_references(issues.values())
+    return issues
+
+class ProjectDeletion(db.Model):
+    """
+    Progress of removing the issues, summaries, identifiers and counter
+    of a deleted project, which is done in batches by a queued task
+    """
+    project_key = db.StringProperty(required=True)
+    slug = db.StringProperty(required=True)
+    name = db.StringProperty(required=True)
+    # number of issues removed so far
+    deleted = db.IntegerProperty(default=0)
+    created_date = db.DateTimeProperty(auto_now_add=True)
+    # moves on with every batch, so a deletion which stops moving
+    # has lost its task
+    modified_date = db.DateTimeProperty(auto_now=True)
+    finished_date = db.DateTimeProperty()
+
+    def delete_batch(self, size):
+        """
+        Remove the next batch of the project's issues and what goes with
+        them, returning True once there is nothing left. Safe to run again
+        if a batch fails part way through
+        """
+        project = db.Key(self.project_key)
+        issues = Issue.all().filter('project =', project).fetch(size)
+        if issues:
+            keys = []
+            for issue in issues:
+                keys.append(issue.key())
+                keys.append(IssueSummary.key_for(issue.key()))
+                keys.append(SearchDocument.key_for(issue.key()))
+                keys.append(IndexPending.key_for(issue.key()))
+            # a new project with the same slug may already be using
+            # some of these identifiers, so only remove our own
+            issue_keys = set(keys)
+            mapping_keys = [IssueIdentifier.key_for(self.slug, issue.identifier) for issue in issues]
+            for mapping in db.get(mapping_keys):
+                if mapping and IssueIdentifier.issue.get_value_for_datastore(mapping) in issue_keys:
+                    keys.append(mapping.key())
+            db.delete(keys)
+            self.deleted += len(issues)
+            self.put()
+            return False
+
+        # summaries and search documents left behind by a batch
+        # which failed part way through
+        for model in (IssueSummary, SearchDocument):
+            keys = model.all(keys_only=True).filter('project =', project).fetch(size)
+            if keys:
+                db.delete(keys)
+                return False
+
+        # a new project with the same slug shares the key, and carries on
+        # from the counter so it can't reuse identifiers still held in
+        # blocks reserved by running instances
+        counter = Counter.get_by_key_name(Counter.key_template % {'project': self.name})
+        if counter and Counter.project.get_value_for_datastore(counter) == project \
+                and db.get(project) is None:
+            counter.delete()
+        self.finished_date = datetime.now()
+        self.put()
+        invalidate_cache(project_dependency(self.slug), PROJECTS_DEPENDENCY)
+        return True
+
+def stalled_deletions(age, size):
+    """
+    Unfinished project deletions which haven't removed a batch for age
+    seconds, as their task was probably never queued
+    """
+    cutoff = datetime.now() - timedelta(seconds=age)
+    deletions = ProjectDeletion.all().filter('finished_date =', None).fetch(size)
+    return [deletion for deletion in deletions
+        if deletion.modified_date is None or deletion.modified_date < cutoff]
+
+# kinds which refer to other entities, and the reference which is
+# checked by the orphan sweeper. Issues come before the identifiers
+# which refer to them so both are removed in a single sweep
+ORPHAN_REFERENCES = [
+    (Issue, 'project'),
+    (IssueSummary, 'project'),
+    (IssueIdentifier, 'issue'),
+    (SearchDocument, 'issue'),
+    (IndexPending, 'issue'),
+    (Counter, 'project'),
+]
+
+def sweep_orphans(model, reference, start=None, size=100):
+    """
+    Check a batch of entities of one kind, in key order after start, and
+    delete any whose reference points at an entity which no longer exists.
+    Returns the last key checked, or None when the kind is finished,
+    along with the number of orphans removed
+    """
+    query = model.all().order('__key__')
+    if start:
+        query.filter('__key__ >', start)
+    entities = query.fetch(size)
+    prop = model.properties()[reference]
+    targets = set([prop.get_value_for_datastore(entity) for entity in entities])
+    existing = set([target.key() for target in db.get(list(targets)) if target])
+    orphans = [entity.key() for entity in entities
+        if prop.get_value_for_datastore(entity) not in existing]
+    if orphans:
+        db.delete(orphans)
+    if len(entities) < size:
+        return None, len(orphans)
+    return entities[-1].key(), len(orphans)
@@ -0,0 +1,61 @@
+class Result(object):
+    """
+    A datastore call which has already finished, used in place of an
+    asynchronous call where the SDK doesn't provide one
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get_result(self):
+        "Return the result of the call"
+        return self.value
+
+class Pending(object):
+    "A datastore call which has been started, with a way to finish it"
+
+    def __init__(self, finish):
+        self.finish = finish
+        self.done = False
+        self.value = None
+
+    def get_result(self):
+        "Wait for the call to finish and return its result"
+        if not self.done:
+            self.value = self.finish()
+            self.done = True
+        return self.value
+
+def fetch_async(query, limit=None):
+    "Start fetching up to limit results from a query, or every result if no limit is given"
+    if limit is None:
+        iterator = query.run()
+        return Pending(lambda: list(iterator))
+    try:
+        iterator = query.run(limit=limit)
+    except TypeError:
+        # older SDKs only run the query when it's fetched
+        return Result(query.fetch(limit))
+    return Pending(lambda: list(iterator))
+
+def count_async(query, limit=None):
+    """
+    Start counting the results of a query, with no limit unless one is
+    given. Every result is read to count it, so use a keys only query
+    """
+    if limit is None:
+        iterator = query.run()
+    else:
+        try:
+            iterator = query.run(limit=limit)
+        except TypeError:
+            # older SDKs only run the query when it's counted
+            return Result(query.count(limit))
+    return Pending(lambda: sum(1 for result in iterator))
+
+def wait(*calls):
+    """
+    Wait for calls started together and return their results in the same
+    order, so the wait is as long as the slowest rather than all of them
+    """
+    return [call.get_result() for call in calls]
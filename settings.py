@@ -11,5 +11,108 @@ DEBUG = debug
 # enable or disable the memcache here, useful for debugging
 CACHE = not debug
 
+# how long to keep cached pages, in seconds. Cached pages are
+# invalidated when the projects and issues they show change
+CACHE_TIME = 60 * 60 * 24 * 7
+
+# cached values are also kept in instance memory, up to this many bytes
+LOCAL_CACHE_SIZE = 4 * 1024 * 1024
+
+# longest time in seconds to keep a value in instance memory
+LOCAL_CACHE_TIME = 60 * 10
+
+# how long in seconds each instance trusts its copy of a generation
+# counter, which is how long a change can take to show on all instances
+LOCAL_GENERATION_TIME = 5
+
+# only one request rebuilds a missing cached value at a time. Others
+# check for it every CACHE_LOCK_POLL seconds, for up to CACHE_LOCK_WAIT
+# seconds, before building it themselves. The lock expires after
+# CACHE_LOCK_TIME seconds in case the request holding it dies
+CACHE_LOCK_TIME = 30
+CACHE_LOCK_WAIT = 2
+CACHE_LOCK_POLL = 0.1
+
+# feeds and JSON documents are rebuilt after this many seconds so their
+# dates stay current. Until then the old copy is served to everyone
+# else, rather than all of them missing the cache at once
+FEED_REFRESH_TIME = 60 * 15
+JSON_REFRESH_TIME = 60 * 5
+
+# pages, feeds and JSON at least this many bytes long are cached gzipped
+# and sent that way to clients which accept it
+GZIP_MIN_SIZE = 4 * 1024
+
+# how long in seconds browsers and front end caches may keep each kind of
+# page when it's served to a logged out user. Pages for logged in users
+# are always sent as private and never stored
+CACHE_CONTROL = {
+    'home': 60 * 60,
+    'faq': 60 * 60,
+    'projects': 60 * 5,
+    'project': 60,
+    'issue': 60,
+    'feed': 60 * 15,
+    'json': 60 * 5,
+    'search': 60 * 5,
+    'suggest': 60,
+}
+
 # URL of the current system, used in feeds
-SYSTEM_URL = "http://gitbug.appspot.com"
\ No newline at end of file
+SYSTEM_URL = "http://gitbug.appspot.com"
+
+# number of projects to work through in each request of a repair job
+REPAIR_BATCH_SIZE = 20
+
+# each instance reserves this many issue identifiers from a project's
+# counter at a time, so busy projects don't all write to the counter.
+# Larger blocks mean fewer writes but bigger gaps between identifiers
+IDENTIFIER_BLOCK_SIZE = 10
+
+# number of issues shown on each page of a project
+ISSUES_PAGE_SIZE = 50
+
+# number of projects shown on each page of the projects directory
+PROJECTS_PAGE_SIZE = 50
+
+# number of issues removed by each task when deleting a project,
+# and of entities checked by each task of the orphan sweeper
+DELETE_BATCH_SIZE = 100
+
+# project deletions which haven't moved on for this many seconds are
+# queued again by a regular job, in case their task was lost
+DELETION_REQUEUE_AGE = 60 * 10
+
+# most different words indexed for a single issue, and most matching
+# issues ranked for a single search
+SEARCH_MAX_TERMS = 500
+SEARCH_CANDIDATES = 200
+
+# number of search results shown on each page
+SEARCH_PAGE_SIZE = 20
+
+# changes to an issue's text within this many seconds are indexed for
+# search by a single queued task, run once the period is over
+INDEX_DELAY = 10
+
+# issues waiting longer than this many seconds to be indexed are queued
+# again by a regular job, this many at a time, in case their task was lost
+INDEX_REQUEUE_AGE = INDEX_DELAY * 6
+INDEX_REQUEUE_BATCH_SIZE = 100
+
+# most results kept for a search across every project a user can see
+SEARCH_MAX_RESULTS = 500
+
+# most projects searched with a query each, beyond which a single query
+# for the words is filtered down to the projects, ranking this many
+SEARCH_MAX_PROJECTS = 20
+SEARCH_GLOBAL_CANDIDATES = 1000
+
+# most issues suggested for the name typed into the add issue form,
+# how many of a project's newest issues the index is built from, how
+# much of each name is kept and the most bytes kept in the index, well
+# under the datastore's limit for an entity
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_ISSUES = 2000
+SUGGEST_NAME_LENGTH = 100
+SUGGEST_MAX_BYTES = 500 * 1024
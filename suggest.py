@@ -0,0 +1,211 @@
+import bisect
+
+from google.appengine.ext import db
+
+from lib import cached, invalidate_cache, versioned_key, LOCAL_CACHE
+from fulltext import WORD_RE
+import settings
+
+class SuggestIndex(db.Model):
+    """
+    The url and name of the newest issues in a project, a line for each
+    in the order they were added, kept in one entity so the prefix index
+    used to suggest issues can be built with a single get
+    """
+    entries = db.TextProperty()
+
+    key_template = 'suggest/%(project)s'
+
+    @classmethod
+    def key_for(cls, project_slug):
+        "Key of the index for a project"
+        return db.Key.from_path(cls.kind(), cls.key_template % {'project': project_slug})
+
+def parse(text):
+    "Read the stored entries back as a list of (url, name) pairs"
+    entries = []
+    for line in (text or "").splitlines():
+        if line:
+            url, name = line.split("\t", 1)
+            entries.append((url, name))
+    return entries
+
+def words_of(text):
+    "The distinct lower case words of some text, for matching prefixes"
+    words = []
+    for word in WORD_RE.findall(unicode(text or "").lower()):
+        if not word in words:
+            words.append(word)
+    return words
+
+def suggest_dependency(slug):
+    """
+    Name of the cache dependency for a project's prefix index, which
+    changes only when issues are added, renamed or deleted
+    """
+    return "suggest_%s" % slug
+
+def serialize(entries):
+    """
+    Store (url, name) entries as text, dropping the oldest once they'd
+    take more than SUGGEST_MAX_BYTES so the index stays well inside the
+    largest entity the datastore will save
+    """
+    lines = [u"%s\t%s" % entry for entry in entries]
+    size = 0
+    kept = 0
+    for line in reversed(lines):
+        size += len(line.encode('utf8')) + 1
+        if size > settings.SUGGEST_MAX_BYTES:
+            break
+        kept += 1
+    return db.Text(u"\n".join(lines[len(lines) - kept:]))
+
+def clean(name):
+    "An issue name as kept in the index, as tabs and new lines would break the format"
+    return " ".join(name.split())[:settings.SUGGEST_NAME_LENGTH]
+
+def update_suggestions(project_slug, url, name=None):
+    """
+    Add or rename an issue in a project's index, or remove it if no name
+    is given. Nothing is done if the index hasn't been built yet, as it
+    is built from the issue summaries when first needed. Renamed issues
+    keep their place, so they're still ordered by when they were added
+    """
+    def change():
+        index = SuggestIndex.get(SuggestIndex.key_for(project_slug))
+        if index is None:
+            return False
+        entries = parse(index.entries)
+        urls = [entry[0] for entry in entries]
+        if name is None:
+            if not url in urls:
+                return False
+            del entries[urls.index(url)]
+        elif url in urls:
+            entry = (url, clean(name))
+            if entries[urls.index(url)] == entry:
+                return False
+            entries[urls.index(url)] = entry
+        else:
+            entries.append((url, clean(name)))
+        index.entries = serialize(entries)
+        index.put()
+        return True
+    if db.run_in_transaction(change):
+        invalidate_cache(suggest_dependency(project_slug))
+
+def issue_indexed(issue_key, issue):
+    """
+    Bring a project's index up to date with an issue once it has been
+    indexed for search, or with its removal if it's been deleted. This
+    runs from the queue so adding issues doesn't wait on the one index
+    every issue in the project shares
+    """
+    if issue is None:
+        # deleted issues are only known by their key, stored under
+        # issue/<project>/<slug> like their url
+        parts = (issue_key.name() or "").split("/")
+        if len(parts) == 3 and parts[0] == "issue":
+            update_suggestions(parts[1], "/%s/%s/" % (parts[1], parts[2]))
+        return
+    project = issue.project
+    # left from a deleted project with the same slug
+    if issue.created_date < project.created_date:
+        return
+    update_suggestions(project.slug, issue.internal_url, issue.name)
+
+def build(slug):
+    """
+    Build and save the index for a project from its issue summaries,
+    or return None if there's no project. An index saved while this one
+    was being built is kept, as it may have changes this one missed
+    """
+    # models keeps this index up to date so can't be imported first
+    from models import IssueSummary, get_project
+    project = get_project(slug)
+    if project is None:
+        return None
+    keys = IssueSummary.all(keys_only=True).filter('project =', project).order(
+        '-created_date').fetch(settings.SUGGEST_MAX_ISSUES)
+    # the query can be behind, so read the summaries themselves to
+    # leave out issues just deleted
+    summaries = [summary for summary in db.get(keys) if summary is not None
+        # and any left from a deleted project with the same slug
+        and summary.created_date >= project.created_date]
+    summaries.reverse()
+    entries = serialize([(summary.internal_url, clean(summary.name)) for summary in summaries])
+    def create():
+        index = SuggestIndex.get(SuggestIndex.key_for(slug))
+        if index is None:
+            index = SuggestIndex(key=SuggestIndex.key_for(slug), entries=entries)
+            index.put()
+        return index
+    return db.run_in_transaction(create)
+
+def prefix_table(slug):
+    """
+    The prefix index for a project as a sorted list of (word, position)
+    pairs and the (url, name) entries they point to. The entries are
+    shared through memcache while the sorted words are only kept in
+    instance memory, as they're several times the size. Returns None
+    if there's no project
+    """
+    dependency = suggest_dependency(slug)
+    key = versioned_key("suggest_table_%s" % slug, [dependency])
+    table = settings.CACHE and LOCAL_CACHE.get(key)
+    if not table:
+        def load():
+            index = SuggestIndex.get(SuggestIndex.key_for(slug)) or build(slug)
+            return index and parse(index.entries)
+        entries = cached("suggest_%s" % slug, load, depends=[dependency])
+        if entries is None:
+            return None
+        words = []
+        for position, (url, name) in enumerate(entries):
+            for word in words_of(name):
+                words.append((word, position))
+        words.sort()
+        table = (words, entries)
+        if settings.CACHE:
+            LOCAL_CACHE.set(key, table, settings.LOCAL_CACHE_TIME)
+    return table
+
+def matches(typed, words):
+    "Check every word typed is the start of one of the words"
+    for prefix in typed:
+        if not [word for word in words if word.startswith(prefix)]:
+            return False
+    return True
+
+def suggest(slug, text, limit=None):
+    """
+    Find the issues in a project whose names have a word starting with
+    each word typed, newest first, returning at most limit (url, name)
+    pairs, or None if there's no project
+    """
+    limit = limit or settings.SUGGEST_LIMIT
+    table = prefix_table(slug)
+    if table is None:
+        return None
+    words, entries = table
+    typed = words_of(text)
+    if not typed:
+        return []
+    # look up the longest word typed, which matches the fewest issues,
+    # and check the rest against the names found
+    longest = max(typed, key=len)
+    positions = {}
+    for index in xrange(bisect.bisect_left(words, (longest, -1)), len(words)):
+        word, position = words[index]
+        if not word.startswith(longest):
+            break
+        positions[position] = True
+    found = []
+    for position in sorted(positions.keys(), reverse=True):
+        url, name = entries[position]
+        if matches(typed, words_of(name)):
+            found.append((url, name))
+            if len(found) == limit:
+                break
+    return found
@@ -0,0 +1,78 @@
+import time
+import hashlib
+import logging
+
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    # older SDKs only have the experimental version
+    from google.appengine.api.labs import taskqueue
+
+from fulltext import reindex
+import settings
+
+def queue_project_deletion(deletion):
+    "Queue the next batch of removing a deleted project's issues"
+    taskqueue.add(url="/admin/tasks/deleteproject/",
+        params={'deletion': str(deletion.key())})
+
+def queue_orphan_sweep(kind=0, start=None):
+    """
+    Queue the next batch of the orphan sweeper, for the kind at this
+    position in models.ORPHAN_REFERENCES starting after the start key
+    """
+    params = {'kind': kind}
+    if start:
+        params['start'] = str(start)
+    taskqueue.add(url="/admin/tasks/sweeporphans/", params=params)
+
+class LocalQueue(object):
+    """
+    Keeps queued indexing in memory to be run when asked, used in place
+    of the task queue by tests. Changes to the same issue are coalesced
+    just as named tasks coalesce them
+    """
+
+    def __init__(self):
+        self.keys = []
+
+    def add(self, issue_key):
+        "Queue an issue for indexing unless it's already waiting"
+        if not issue_key in self.keys:
+            self.keys.append(issue_key)
+
+    def run(self):
+        "Index every waiting issue, returning how many there were"
+        keys, self.keys = self.keys, []
+        for key in keys:
+            reindex(key)
+        return len(keys)
+
+# set to a LocalQueue to index in process rather than with tasks
+INDEX_QUEUE = None
+
+def queue_index(issue_key, prefix="index"):
+    """
+    Queue an issue to be indexed for search. Tasks are named after the
+    issue and the period it was changed in, so every change in the same
+    period shares a task which runs once the period is over. Tasks
+    queued again by the requeue job use their own prefix so they're
+    never taken for one already used
+    """
+    if INDEX_QUEUE is not None:
+        INDEX_QUEUE.add(issue_key)
+        return
+    now = time.time()
+    period = int(now / settings.INDEX_DELAY)
+    name = "%s-%s-%s" % (prefix, hashlib.md5(str(issue_key)).hexdigest(), period)
+    try:
+        taskqueue.add(name=name, url="/admin/tasks/index/",
+            params={'issue': str(issue_key)},
+            countdown=(period + 1) * settings.INDEX_DELAY - now)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # already queued by an earlier change
+        pass
+    except Exception, e:
+        # the issue is saved by now, and its marker is queued again
+        # later by the requeue job, so don't fail the request
+        logging.error("error queueing indexing for %s: %s" % (issue_key, e))
@@ -3,11 +3,19 @@
 import sys
 import os
 import unittest
+from datetime import datetime, timedelta
+import base64
 from webtest import TestApp, AppError
 
 from google.appengine.api import urlfetch, mail_stub, apiproxy_stub_map, urlfetch_stub, user_service_stub, datastore_file_stub
 from google.appengine.api.memcache import memcache_stub
 from google.appengine.api.urlfetch import DownloadError, InvalidURLError
+from google.appengine.api import users
+from google.appengine.ext import db
+try:
+    from google.appengine.api.taskqueue import taskqueue_stub
+except ImportError:
+    from google.appengine.api.labs.taskqueue import taskqueue_stub
 
 # insert application path
 app_path = os.path.join(
@@ -16,6 +24,9 @@ app_path = os.path.join(
 sys.path.insert(0, app_path)
 
 from admin import application
+from fulltext import IndexPending
+import tasks
+from models import Project, Issue, IssueSummary, IssueIdentifier, Counter, ProjectDeletion
 import settings 
 
 class AdminTest(unittest.TestCase):
@@ -29,6 +40,10 @@ class AdminTest(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())        
         stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
         apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+        self.queue = taskqueue_stub.TaskQueueServiceStub(root_path=app_path)
+        apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', self.queue)
+        # index with queued tasks, as other tests may have set up a local queue
+        tasks.INDEX_QUEUE = None
         
         os.environ['APPLICATION_ID'] = "temp"
         os.environ['USER_EMAIL'] = "test@example.com"
@@ -62,7 +77,142 @@ class AdminTest(unittest.TestCase):
         response = self.app.post('/admin/clearcache', expect_errors=True)        
         self.assertEquals("302 Moved Temporarily", response.status)
 
+    def run_tasks(self):
+        "Run queued tasks, and any they queue in turn, until none are left"
+        tasks = self.queue.GetTasks('default')
+        while tasks:
+            self.queue.FlushQueue('default')
+            for task in tasks:
+                response = self.app.post(task['url'], base64.b64decode(task['body']))
+                self.assertEquals("200 OK", response.status)
+            tasks = self.queue.GetTasks('default')
 
+    def add_issues(self, project, count):
+        "Save issues directly in bulk, with their summaries and identifiers"
+        for first in range(0, count, 500):
+            issues = []
+            for identifier in range(first + 1, min(first + 500, count) + 1):
+                issues.append(Issue(
+                    key_name="issue/%s/issue-%s" % (project.slug, identifier),
+                    name="issue %s" % identifier,
+                    project=project,
+                    identifier=identifier,
+                    internal_url="/%s/issue-%s/" % (project.slug, identifier),
+                ))
+            db.put(issues)
+            db.put([IssueSummary.for_issue(issue) for issue in issues])
+            db.put([IssueIdentifier.for_issue(issue) for issue in issues])
+        Counter(key_name="counter/%s" % project.name, project=project, count=count).put()
+
+    def test_deleting_project_removes_everything_in_batches(self):
+        project = Project(name="big", user=users.User("test@example.com"))
+        project.put()
+        # raise to tens of thousands to try out a really large project
+        issue_count = 1000
+        self.add_issues(project, issue_count)
+        other = Project(name="other", user=users.User("test@example.com"))
+        other.put()
+        self.add_issues(other, 5)
+
+        project.delete()
+        self.assertEquals(Project.get_by_key_name("project/big"), None)
+        self.run_tasks()
+
+        deletion = ProjectDeletion.all().get()
+        self.assertEquals(deletion.deleted, issue_count)
+        self.assertTrue(deletion.finished_date)
+        for model in (Issue, IssueSummary, IssueIdentifier, Counter):
+            self.assertEquals(model.all().count(), model is Counter and 1 or 5)
+
+    def test_sweeper_removes_orphans(self):
+        project = Project(name="orphaned", user=users.User("test@example.com"))
+        project.put()
+        self.add_issues(project, 150)
+        kept = Project(name="kept", user=users.User("test@example.com"))
+        kept.put()
+        self.add_issues(kept, 5)
+        # delete the project the way it was done before issues were removed
+        db.delete(project)
+
+        response = self.app.post('/admin/sweeporphans/', expect_errors=True)
+        self.assertEquals("302 Moved Temporarily", response.status)
+        self.run_tasks()
+        for model in (Issue, IssueSummary, IssueIdentifier, Counter):
+            self.assertEquals(model.all().count(), model is Counter and 1 or 5)
+
+    def test_index_shows_search_lag(self):
+        project = Project(name="indexed", user=users.User("test@example.com"))
+        project.put()
+        index_delay = settings.INDEX_DELAY
+        settings.INDEX_DELAY = 60 * 60
+        try:
+            issue = Issue(name="first", project=project)
+            issue.put()
+            issue.description = "edited"
+            issue.put()
+        finally:
+            settings.INDEX_DELAY = index_delay
+        self.assertEquals(len(self.queue.GetTasks('default')), 1)
+        response = self.app.get('/admin/', expect_errors=True)
+        response.mustcontain("1 issue waiting to be indexed")
+        self.run_tasks()
+        response = self.app.get('/admin/', expect_errors=True)
+        response.mustcontain("Every issue has been indexed")
+
+
+    def test_failed_queueing_doesnt_fail_the_save(self):
+        project = Project(name="unqueued", user=users.User("test@example.com"))
+        project.put()
+        def fail(*args, **kwargs):
+            raise Exception("queue unavailable")
+        add = tasks.taskqueue.add
+        tasks.taskqueue.add = fail
+        try:
+            Issue(name="first", project=project).put()
+        finally:
+            tasks.taskqueue.add = add
+        self.assertEquals(Project.get(project.key()).open_count, 1)
+        self.assertEquals(IndexPending.all().count(), 1)
+
+    def test_stale_markers_are_queued_again(self):
+        project = Project(name="stale", user=users.User("test@example.com"))
+        project.put()
+        issue = Issue(name="first", project=project)
+        issue.put()
+        self.queue.FlushQueue('default')
+        marker = IndexPending.all().get()
+        marker.modified_date = datetime.now() - timedelta(seconds=settings.INDEX_REQUEUE_AGE + 1)
+        marker.put()
+        response = self.app.get('/admin/tasks/requeueindex/', expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+        self.assertEquals(len(self.queue.GetTasks('default')), 1)
+        self.run_tasks()
+        self.assertEquals(IndexPending.all().count(), 0)
+
+    def test_stalled_deletions_are_queued_again(self):
+        project = Project(name="stalled", user=users.User("test@example.com"))
+        project.put()
+        self.add_issues(project, 5)
+        def fail(*args, **kwargs):
+            raise Exception("queue unavailable")
+        add = tasks.taskqueue.add
+        tasks.taskqueue.add = fail
+        try:
+            project.delete()
+        finally:
+            tasks.taskqueue.add = add
+        self.assertEquals(Project.get_by_key_name("project/stalled"), None)
+        self.assertEquals(ProjectDeletion.all().get().finished_date, None)
+        age = settings.DELETION_REQUEUE_AGE
+        settings.DELETION_REQUEUE_AGE = 0
+        try:
+            response = self.app.get('/admin/tasks/requeuedeletions/', expect_errors=True)
+        finally:
+            settings.DELETION_REQUEUE_AGE = age
+        self.assertEquals("200 OK", response.status)
+        self.run_tasks()
+        self.assertTrue(ProjectDeletion.all().get().finished_date)
+        self.assertEquals(Issue.all().count(), 0)
                                        
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
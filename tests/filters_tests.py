@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+from datetime import datetime
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+from filters import fragment_key
+
+class FakeEntity(object):
+    def __init__(self, key, modified_date):
+        self._key = key
+        self.modified_date = modified_date
+
+    def key(self):
+        return self._key
+
+class FragmentKeyTest(unittest.TestCase):
+
+    def test_key_changes_when_modified(self):
+        before = FakeEntity("test", datetime(2009, 1, 1, 12, 0, 0, 1))
+        after = FakeEntity("test", datetime(2009, 1, 1, 12, 0, 0, 2))
+        self.assertNotEqual(fragment_key("issue", before), fragment_key("issue", after))
+
+    def test_key_is_per_object(self):
+        date = datetime(2009, 1, 1)
+        self.assertNotEqual(fragment_key("issue", FakeEntity("a", date)),
+            fragment_key("issue", FakeEntity("b", date)))
+
+    def test_key_is_per_fragment(self):
+        entity = FakeEntity("test", datetime(2009, 1, 1))
+        self.assertNotEqual(fragment_key("issue", entity), fragment_key("project", entity))
+
+    def test_unmodified_objects_have_a_key(self):
+        self.assertEqual(fragment_key("issue", FakeEntity("test", None)), "fragment_issue_test_0")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+
+from google.appengine.api import mail_stub, apiproxy_stub_map, user_service_stub, datastore_file_stub, users
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import db
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+import tasks
+from tasks import LocalQueue
+from lib import LOCAL_CACHE, IDENTITY_MAP
+from models import Project, Issue, IDENTIFIERS, PROJECT_KEYS
+from fulltext import SearchDocument, IndexPending, stem, tokenize, search, search_projects, index_lag
+from fulltext import result_cursor, results_after
+import settings
+
+class StemTest(unittest.TestCase):
+
+    def test_stem(self):
+        tests = [
+            ['crash', 'crash'],
+            ['crashes', 'crash'],
+            ['crashed', 'crash'],
+            ['crashing', 'crash'],
+            ['queries', 'query'],
+            ['bug', 'bug'],
+        ]
+        for input, output in tests:
+            self.assertEqual(stem(input), output)
+
+    def test_tokenize_leaves_out_common_words(self):
+        self.assertEqual(tokenize("The page is crashing"), ['page', 'crash'])
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('mail', mail_stub.MailServiceStub())
+        apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+        stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+        LOCAL_CACHE.clear()
+        tasks.INDEX_QUEUE = LocalQueue()
+        IDENTIFIERS.blocks.clear()
+        PROJECT_KEYS.clear()
+        IDENTITY_MAP.clear()
+
+        os.environ['APPLICATION_ID'] = "temp"
+        os.environ['USER_EMAIL'] = "test@example.com"
+        os.environ['SERVER_NAME'] = "example.com"
+        os.environ['SERVER_PORT'] = "80"
+
+        self.project = Project(name="test", user=users.User("test@example.com"))
+        self.project.put()
+
+    def test_search_matches_every_word(self):
+        first = Issue(name="Login page crashes", description="in firefox", project=self.project)
+        first.put()
+        second = Issue(name="Login button colour", project=self.project)
+        second.put()
+        tasks.INDEX_QUEUE.run()
+        found = search(self.project.key(), "login")
+        self.assertEqual(sorted(map(str, found)), sorted([str(first.key()), str(second.key())]))
+        self.assertEqual(search(self.project.key(), "crashing login"), [first.key()])
+        self.assertEqual(search(self.project.key(), "the"), [])
+
+    def test_name_ranks_above_description(self):
+        described = Issue(name="Slow", description="the search page", project=self.project)
+        described.put()
+        named = Issue(name="Search is slow", project=self.project)
+        named.put()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(search(self.project.key(), "search"), [named.key(), described.key()])
+
+    def test_search_is_limited_to_project(self):
+        other = Project(name="other", user=users.User("test@example.com"))
+        other.put()
+        Issue(name="crash", project=other).put()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(search(self.project.key(), "crash"), [])
+
+    def test_search_several_projects(self):
+        other = Project(name="other", user=users.User("test@example.com"))
+        other.put()
+        first = Issue(name="crash", project=self.project)
+        first.put()
+        second = Issue(name="crash crash", project=other)
+        second.put()
+        tasks.INDEX_QUEUE.run()
+        found = search_projects([self.project.key(), other.key()], "crash")
+        self.assertEqual([key for score, key in found], [second.key(), first.key()])
+        self.assertEqual(search_projects([self.project.key()], "crash"), [(3, first.key())])
+
+    def test_search_many_projects_with_one_query(self):
+        hidden = Project(name="hidden", user=users.User("test@example.com"))
+        hidden.put()
+        Issue(name="crash", project=hidden).put()
+        issue = Issue(name="crash", project=self.project)
+        issue.put()
+        tasks.INDEX_QUEUE.run()
+        max_projects = settings.SEARCH_MAX_PROJECTS
+        settings.SEARCH_MAX_PROJECTS = 1
+        try:
+            others = [db.Key.from_path('Project', 'gone-%s' % number) for number in range(3)]
+            found = search_projects(others + [self.project.key()], "crash")
+            self.assertEqual(found, [(3, issue.key())])
+        finally:
+            settings.SEARCH_MAX_PROJECTS = max_projects
+
+    def test_results_after_cursor(self):
+        first = str(db.Key.from_path('Issue', 'a'))
+        second = str(db.Key.from_path('Issue', 'b'))
+        third = str(db.Key.from_path('Issue', 'c'))
+        results = [(6, first), (3, second), (3, third)]
+        self.assertEqual(results_after(results, ""), results)
+        self.assertEqual(results_after(results, result_cursor(results[0])), results[1:])
+        # the result the cursor was made from has gone
+        self.assertEqual(results_after(results[1:], result_cursor(results[0])), results[1:])
+        self.assertEqual(results_after(results, result_cursor(results[2])), [])
+        self.assertRaises(ValueError, results_after, results, "3")
+        self.assertRaises(ValueError, results_after, results, "3:nonsense")
+
+    def test_indexing_waits_for_the_queue(self):
+        issue = Issue(name="crash", project=self.project)
+        issue.put()
+        self.assertEqual(search(self.project.key(), "crash"), [])
+        self.assertEqual(index_lag()[0], 1)
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(search(self.project.key(), "crash"), [issue.key()])
+        self.assertEqual(index_lag(), (0, None))
+
+    def test_only_text_changes_are_queued(self):
+        issue = Issue(name="crash", project=self.project)
+        issue.put()
+        tasks.INDEX_QUEUE.run()
+        issue = Issue.get(issue.key())
+        issue.fixed = True
+        issue.put()
+        self.assertEqual(tasks.INDEX_QUEUE.run(), 0)
+        issue.description = "on startup"
+        issue.put()
+        self.assertEqual(tasks.INDEX_QUEUE.run(), 1)
+        self.assertEqual(search(self.project.key(), "startup crash"), [issue.key()])
+
+    def test_changes_are_coalesced(self):
+        issue = Issue(name="crash", project=self.project)
+        issue.put()
+        for number in range(10, 20):
+            issue.description = "version %s" % number
+            issue.put()
+        self.assertEqual(IndexPending.all().count(), 1)
+        self.assertEqual(tasks.INDEX_QUEUE.run(), 1)
+        self.assertEqual(search(self.project.key(), "19"), [issue.key()])
+        self.assertEqual(search(self.project.key(), "10"), [])
+
+    def test_delete_removes_document(self):
+        issue = Issue(name="crash", project=self.project)
+        issue.put()
+        tasks.INDEX_QUEUE.run()
+        issue.delete()
+        self.assertEqual(SearchDocument.all().count(), 0)
+
+    def test_deleted_before_indexing(self):
+        issue = Issue(name="crash", project=self.project)
+        issue.put()
+        issue.delete()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(SearchDocument.all().count(), 0)
+        self.assertEqual(IndexPending.all().count(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
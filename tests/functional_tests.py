@@ -15,7 +15,14 @@ app_path = os.path.join(
 )
 sys.path.insert(0, app_path)
 
+from google.appengine.api import users
+from django.utils import simplejson
+
 from main import application
+import tasks
+from tasks import LocalQueue
+from lib import LOCAL_CACHE, delete_cache
+from models import Project, Issue, PROJECT_KEYS
 import settings 
 
 class FunctionalTest(unittest.TestCase):
@@ -34,6 +41,8 @@ class FunctionalTest(unittest.TestCase):
         os.environ['USER_EMAIL'] = "test@example.com"
         os.environ['SERVER_NAME'] = "example.com"
         os.environ['SERVER_PORT'] = "80"
+        LOCAL_CACHE.clear()
+        tasks.INDEX_QUEUE = LocalQueue()
         
 
     def test_index_returns_200(self):  
@@ -47,6 +56,191 @@ class FunctionalTest(unittest.TestCase):
     def test_web_view_return_correct_mime_type(self):
         response = self.app.get('/', expect_errors=True)
         self.assertEquals(response.content_type, "text/html")
+
+    def test_etag_and_last_modified_sent(self):
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/faq/', expect_errors=True)
+        self.assertTrue(response.headers.get('ETag'))
+        self.assertTrue(response.headers.get('Last-Modified'))
+
+    def test_matching_etag_returns_304(self):
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/faq/', expect_errors=True)
+        etag = response.headers['ETag']
+        response = self.app.get('/faq/', headers={'If-None-Match': etag}, expect_errors=True)
+        self.assertEquals("304 Not Modified", response.status)
+
+    def test_current_if_modified_since_returns_304(self):
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/faq/', expect_errors=True)
+        modified = response.headers['Last-Modified']
+        response = self.app.get('/faq/', headers={'If-Modified-Since': modified}, expect_errors=True)
+        self.assertEquals("304 Not Modified", response.status)
+
+    def test_different_etag_returns_page(self):
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/faq/', headers={'If-None-Match': '"old"'}, expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+
+    def test_logged_in_user_gets_their_own_greeting(self):
+        os.environ['USER_EMAIL'] = ""
+        self.app.get('/faq/', expect_errors=True)
+        os.environ['USER_EMAIL'] = "test@example.com"
+        response = self.app.get('/faq/', expect_errors=True)
+        response.mustcontain("Sign out")
+
+    def test_public_cache_headers_when_logged_out(self):
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/faq/', expect_errors=True)
+        self.assertEquals(response.headers['Cache-Control'],
+            "public, max-age=%d" % settings.CACHE_CONTROL['faq'])
+        self.assertTrue("Cookie" in response.headers['Vary'])
+        self.assertTrue(response.headers.get('Expires'))
+
+    def test_private_cache_headers_when_logged_in(self):
+        response = self.app.get('/faq/', expect_errors=True)
+        self.assertEquals(response.headers['Cache-Control'], "private, no-store")
+
+    def test_logged_out_user_gets_login_link(self):
+        os.environ['USER_EMAIL'] = "test@example.com"
+        self.app.get('/faq/', expect_errors=True)
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/faq/', expect_errors=True)
+        response.mustcontain("Login or Sign up")
+
+    def test_project_issues_are_paged(self):
+        os.environ['USER_EMAIL'] = ""
+        project = Project(name="paging", user=users.User("test@example.com"))
+        project.put()
+        for name in ("first", "second", "third"):
+            Issue(name=name, project=project).put()
+        page_size = settings.ISSUES_PAGE_SIZE
+        settings.ISSUES_PAGE_SIZE = 2
+        try:
+            response = self.app.get('/projects/paging/', expect_errors=True)
+            response.mustcontain("3 issues", "Next page")
+            self.assertFalse("third" in response.body)
+            response = response.click("Next page")
+            response.mustcontain("third", "First page")
+            self.assertFalse("Next page" in response.body)
+        finally:
+            settings.ISSUES_PAGE_SIZE = page_size
+
+    def test_bad_cursor_returns_404(self):
+        os.environ['USER_EMAIL'] = ""
+        Project(name="paging", user=users.User("test@example.com")).put()
+        response = self.app.get('/projects/paging/?cursor=nonsense', expect_errors=True)
+        self.assertEquals("404 Not Found", response.status)
+
+    def test_projects_directory_is_paged(self):
+        os.environ['USER_EMAIL'] = ""
+        for name in ("first", "second", "third"):
+            Project(name=name, user=users.User("test@example.com")).put()
+        page_size = settings.PROJECTS_PAGE_SIZE
+        settings.PROJECTS_PAGE_SIZE = 2
+        try:
+            response = self.app.get('/projects/', expect_errors=True)
+            response.mustcontain("Next page")
+            response = response.click("Next page")
+            response.mustcontain("First page")
+            self.assertFalse("Next page" in response.body)
+            response = self.app.get('/projects.json', expect_errors=True)
+            response.mustcontain("next_url")
+        finally:
+            settings.PROJECTS_PAGE_SIZE = page_size
+
+    def test_issue_page_lists_other_open_issues(self):
+        os.environ['USER_EMAIL'] = ""
+        project = Project(name="sidebar", user=users.User("test@example.com"))
+        project.put()
+        Issue(name="shown issue", project=project).put()
+        Issue(name="other open issue", project=project).put()
+        Issue(name="fixed issue", project=project, fixed=True).put()
+        response = self.app.get('/projects/sidebar/shown-issue/', expect_errors=True)
+        response.mustcontain("other open issue")
+        self.assertFalse("fixed issue" in response.body)
+
+    def test_project_search(self):
+        os.environ['USER_EMAIL'] = ""
+        project = Project(name="searching", user=users.User("test@example.com"))
+        project.put()
+        Issue(name="login crashes", project=project).put()
+        Issue(name="wrong colour", project=project).put()
+        tasks.INDEX_QUEUE.run()
+        response = self.app.get('/projects/searching/search/?q=crashing', expect_errors=True)
+        response.mustcontain("1 matching issue", "login crashes")
+        self.assertFalse("wrong colour" in response.body)
+        # the same words typed differently are shown as they were typed
+        response = self.app.get('/projects/searching/search/?q=Crashes', expect_errors=True)
+        response.mustcontain("1 matching issue", 'value="Crashes"')
+        response = self.app.get('/projects/searching/search/?q=caf%C3%A9', expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+        response.mustcontain("0 matching issues")
+
+    def test_search_of_legacy_project_follows_indexing(self):
+        os.environ['USER_EMAIL'] = ""
+        project = Project(name="legacy", user=users.User("test@example.com"), key_name=None)
+        project.put()
+        Issue(name="login crashes", project=project).put()
+        tasks.INDEX_QUEUE.run()
+        response = self.app.get('/projects/legacy/search/?q=crash', expect_errors=True)
+        response.mustcontain("1 matching issue")
+        Issue(name="crash on save", project=project).put()
+        tasks.INDEX_QUEUE.run()
+        # as in a new instance which hasn't remembered the project's key
+        PROJECT_KEYS.clear()
+        delete_cache("project_key_legacy")
+        response = self.app.get('/projects/legacy/search/?q=crash', expect_errors=True)
+        response.mustcontain("2 matching issues")
+
+    def test_search_across_visible_projects(self):
+        os.environ['USER_EMAIL'] = "test@example.com"
+        owned = Project(name="owned", user=users.User("test@example.com"))
+        owned.put()
+        shared = Project(name="shared", user=users.User("other@example.com"),
+            other_users=["test@example.com"])
+        shared.put()
+        hidden = Project(name="hidden", user=users.User("other@example.com"))
+        hidden.put()
+        for project in (owned, shared, hidden):
+            Issue(name="crash in %s" % project.name, project=project).put()
+        tasks.INDEX_QUEUE.run()
+        page_size = settings.SEARCH_PAGE_SIZE
+        settings.SEARCH_PAGE_SIZE = 1
+        try:
+            response = self.app.get('/search.json?q=crash', expect_errors=True)
+            json = simplejson.loads(response.body)
+            self.assertEquals(json['total'], 2)
+            self.assertEquals(len(json['issues']), 1)
+            next_url = json['next_url'].replace(settings.SYSTEM_URL, "")
+            # the next page follows the last result even once an earlier one is gone
+            Issue.all().filter('name =', json['issues'][0]['name']).get().delete()
+            response = self.app.get(next_url, expect_errors=True)
+            json2 = simplejson.loads(response.body)
+            self.assertFalse('next_url' in json2)
+            self.assertEquals(len(json2['issues']), 1)
+            projects = [json['issues'][0]['project'], json2['issues'][0]['project']]
+            self.assertEquals(sorted(projects), ["owned", "shared"])
+            response = self.app.get('/search.json?q=crash&cursor=bad', expect_errors=True)
+            self.assertEquals("404 Not Found", response.status)
+        finally:
+            settings.SEARCH_PAGE_SIZE = page_size
+
+    def test_suggest_similar_issues(self):
+        os.environ['USER_EMAIL'] = ""
+        project = Project(name="suggesting", user=users.User("test@example.com"))
+        project.put()
+        Issue(name="login crashes", project=project).put()
+        response = self.app.get('/projects/suggesting/suggest.json?q=log', expect_errors=True)
+        self.assertEquals("200 OK", response.status)
+        self.assertEquals(simplejson.loads(response.body)[0]['name'], "login crashes")
+        response = self.app.get('/projects/missing/suggest.json?q=log', expect_errors=True)
+        self.assertEquals("404 Not Found", response.status)
+
+    def test_search_needs_login(self):
+        os.environ['USER_EMAIL'] = ""
+        response = self.app.get('/search.json?q=crash', expect_errors=True)
+        self.assertEquals("403 Forbidden", response.status)
                                        
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -3,6 +3,11 @@
 import sys
 import os
 import unittest
+import hashlib
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.memcache import memcache_stub
 
 # insert application path
 app_path = os.path.join(
@@ -11,7 +16,13 @@ app_path = os.path.join(
 sys.path.insert(0, app_path)
 
 
-from lib import slugify, textile
+from google.appengine.api import memcache
+
+from lib import slugify, textile, get_cache, set_cache, invalidate_cache, generations
+from lib import LocalCache, LOCAL_CACHE, CACHE_STATS, cached, versioned_key, MAX_KEY_LENGTH, page_key
+from lib import get_cache_multi, set_cache_multi
+from lib import response_entry, decompress, accepts_gzip, mark_slot, fill_slots
+import settings
 
 class SlugifyTest(unittest.TestCase):
 
@@ -36,6 +47,239 @@ class TextileTest(unittest.TestCase):
         ]
         for input, output in tests:
             self.assertEqual(textile(input), output)
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+        LOCAL_CACHE.clear()
+
+    def test_set_and_get(self):
+        set_cache("test", "value")
+        self.assertEqual(get_cache("test"), "value")
+
+    def test_invalidate_removes_dependants(self):
+        set_cache("page", "value", depends=["project_test"])
+        set_cache("feed", "value", depends=["project_test", "projects"])
+        self.assertEqual(get_cache("page", depends=["project_test"]), "value")
+        invalidate_cache("project_test")
+        self.assertEqual(get_cache("page", depends=["project_test"]), None)
+        self.assertEqual(get_cache("feed", depends=["project_test", "projects"]), None)
+
+    def test_invalidate_leaves_other_values(self):
+        set_cache("page", "value", depends=["project_test"])
+        set_cache("other", "value", depends=["project_other"])
+        invalidate_cache("project_test")
+        self.assertEqual(get_cache("other", depends=["project_other"]), "value")
+
+    def test_value_needs_same_dependencies(self):
+        set_cache("page", "value", depends=["project_test"])
+        self.assertEqual(get_cache("page", depends=["project_test"]), "value")
+        self.assertEqual(get_cache("page", depends=["project_other"]), None)
+
+    def test_invalidate_moves_generation_on(self):
+        before = generations(["project_test"])[0]
+        invalidate_cache("project_test")
+        self.assertEqual(generations(["project_test"])[0], before + 1)
+
+    def test_many_dependencies_keep_key_short(self):
+        depends = ["project_%s" % number for number in range(100)]
+        set_cache("page", "value", depends=depends)
+        self.assertTrue(len(versioned_key("page", depends)) < MAX_KEY_LENGTH)
+        self.assertEqual(get_cache("page", depends=depends), "value")
+        invalidate_cache("project_50")
+        self.assertEqual(get_cache("page", depends=depends), None)
+
+    def test_page_key_accepts_unicode(self):
+        self.assertEqual(page_key("search", u"caf\xe9"), page_key("search", "caf\xc3\xa9"))
+        self.assertEqual(page_key("search", u""), "search")
+
+    def test_evicted_generation_isnt_reused(self):
+        used = generations(["projects"])
+        for number in range(10):
+            invalidate_cache("projects")
+            used.extend(generations(["projects"]))
+        memcache.flush_all()
+        LOCAL_CACHE.clear()
+        self.assertFalse(generations(["projects"])[0] in used)
+
+    def test_get_and_set_many(self):
+        set_cache_multi({"a": "first", "b": "second"})
+        memcache.delete("b")
+        LOCAL_CACHE.clear()
+        self.assertEqual(get_cache_multi(["a", "b", "c"]), {"a": "first"})
+        self.assertEqual(LOCAL_CACHE.get("a"), "first")
+        self.assertEqual(get_cache_multi([]), {})
+
+    def test_get_from_memory_without_memcache(self):
+        set_cache("page", "value")
+        memcache.flush_all()
+        hits = CACHE_STATS['local_hits']
+        self.assertEqual(get_cache("page"), "value")
+        self.assertEqual(CACHE_STATS['local_hits'], hits + 1)
+
+    def test_memcache_value_copied_to_memory(self):
+        memcache.set("page", "value")
+        self.assertEqual(get_cache("page"), "value")
+        self.assertEqual(LOCAL_CACHE.get("page"), "value")
+
+class CachedTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+        LOCAL_CACHE.clear()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return "value"
+
+    def test_computes_once(self):
+        self.assertEqual(cached("page", self.compute), "value")
+        self.assertEqual(cached("page", self.compute), "value")
+        self.assertEqual(self.calls, 1)
+
+    def test_releases_lock(self):
+        cached("page", self.compute)
+        self.assertEqual(memcache.get("lock_page"), None)
+
+    def test_none_is_not_cached(self):
+        self.assertEqual(cached("page", lambda: None), None)
+        self.assertEqual(cached("page", self.compute), "value")
+
+    def test_fresh_value_is_not_refreshed(self):
+        cached("page", self.compute, refresh=60)
+        self.assertEqual(cached("page", self.compute, refresh=60), "value")
+        self.assertEqual(self.calls, 1)
+
+    def test_stale_value_is_refreshed(self):
+        cached("page", self.compute, refresh=-1)
+        self.assertEqual(cached("page", self.compute, refresh=-1), "value")
+        self.assertEqual(self.calls, 2)
+
+    def test_stale_value_served_while_refreshing(self):
+        cached("page", lambda: "stale", refresh=-1)
+        memcache.add("lock_page", 1)
+        self.assertEqual(cached("page", self.compute, refresh=-1), "stale")
+        self.assertEqual(self.calls, 0)
+
+    def test_computes_when_lock_is_held_too_long(self):
+        wait = settings.CACHE_LOCK_WAIT
+        settings.CACHE_LOCK_WAIT = 0
+        try:
+            memcache.add("lock_page", 1)
+            self.assertEqual(cached("page", self.compute), "value")
+            self.assertEqual(self.calls, 1)
+        finally:
+            settings.CACHE_LOCK_WAIT = wait
+
+    def test_stops_waiting_when_lock_is_released(self):
+        memcache.add("lock_page", 1)
+        sleeps = []
+        def release(seconds):
+            # the request holding the lock finishes without caching anything
+            sleeps.append(seconds)
+            memcache.delete("lock_page")
+        sleep = time.sleep
+        time.sleep = release
+        try:
+            self.assertEqual(cached("page", self.compute), "value")
+        finally:
+            time.sleep = sleep
+        self.assertEqual(len(sleeps), 1)
+        self.assertEqual(self.calls, 1)
+
+class FakeRequest(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+class ResponseEntryTest(unittest.TestCase):
+
+    def test_small_bodies_are_not_compressed(self):
+        entry = response_entry("test")
+        self.assertFalse(entry['gzip'])
+        self.assertEqual(entry['body'], "test")
+
+    def test_large_bodies_are_compressed(self):
+        body = "test" * settings.GZIP_MIN_SIZE
+        entry = response_entry(body)
+        self.assertTrue(entry['gzip'])
+        self.assertTrue(len(entry['body']) < len(body))
+        self.assertEqual(decompress(entry['body']), body)
+
+    def test_etag_is_from_uncompressed_body(self):
+        body = "test" * settings.GZIP_MIN_SIZE
+        compressed = response_entry(body)
+        self.assertTrue(compressed['gzip'])
+        min_size = settings.GZIP_MIN_SIZE
+        settings.GZIP_MIN_SIZE = len(body) + 1
+        try:
+            uncompressed = response_entry(body)
+        finally:
+            settings.GZIP_MIN_SIZE = min_size
+        self.assertFalse(uncompressed['gzip'])
+        self.assertEqual(compressed['etag'], uncompressed['etag'])
+        self.assertEqual(compressed['etag'], '"%s"' % hashlib.md5(body).hexdigest())
+
+    def test_accepts_gzip(self):
+        tests = [
+            ['gzip', True],
+            ['gzip, deflate', True],
+            ['deflate, gzip;q=0.5', True],
+            ['gzip;q=0', False],
+            ['gzip;q=0.0', False],
+            ['gzip;q=0.000', False],
+            ['gzip; q=0.001', True],
+            ['gzip;q=1.0', True],
+            ['deflate', False],
+            ['', False],
+        ]
+        for header, accepted in tests:
+            self.assertEqual(accepts_gzip(FakeRequest({'Accept-Encoding': header})), accepted)
+
+class SlotTest(unittest.TestCase):
+
+    def test_fill_slots(self):
+        body = "<p>%s</p><p>%s</p>" % (mark_slot("a.html", "shared"), mark_slot("b.html", "shared"))
+        self.assertEqual(fill_slots(body, lambda name: name), "<p>a.html</p><p>b.html</p>")
+
+    def test_fill_slots_across_lines(self):
+        body = mark_slot("a.html", "\nshared\n")
+        self.assertEqual(fill_slots(body, lambda name: "user"), "user")
+
+    def test_pages_without_slots_are_unchanged(self):
+        self.assertEqual(fill_slots("<p>test</p>", lambda name: "user"), "<p>test</p>")
+
+class LocalCacheTest(unittest.TestCase):
+
+    def test_set_and_get(self):
+        cache = LocalCache(100)
+        cache.set("a", "value", 60)
+        self.assertEqual(cache.get("a"), "value")
+        self.assertEqual(cache.get("b"), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(30)
+        cache.set("a", "x" * 10, 60)
+        cache.set("b", "x" * 10, 60)
+        cache.get("a")
+        cache.set("c", "x" * 10, 60)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "x" * 10)
+        self.assertEqual(cache.get("c"), "x" * 10)
+        self.assertTrue(cache.bytes <= 30)
+
+    def test_expired_values_are_missing(self):
+        cache = LocalCache(100)
+        cache.set("a", "value", -1)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_values_larger_than_cache_are_skipped(self):
+        cache = LocalCache(10)
+        cache.set("a", "x" * 20, 60)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.bytes, 0)
                 
                                        
 if __name__ == "__main__":
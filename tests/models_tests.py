@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+import threading
+
+from google.appengine.api import mail_stub, apiproxy_stub_map, user_service_stub, datastore_file_stub, users
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import db
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+import tasks
+from tasks import LocalQueue
+from lib import get_cache, set_cache, LOCAL_CACHE, IDENTITY_MAP
+from models import Project, Issue, Counter, IssueIdentifier, IssueSummary, PROJECTS_DEPENDENCY, project_dependency
+from models import IdentifierAllocator, IDENTIFIERS, get_project, PROJECT_KEYS
+from models import get_issue, get_issues_by_identifier, prefetch_references, DuplicateIssue
+from models import DuplicateProject
+
+class ModelTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('mail', mail_stub.MailServiceStub())
+        apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+        stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+        LOCAL_CACHE.clear()
+        tasks.INDEX_QUEUE = LocalQueue()
+        IDENTIFIERS.blocks.clear()
+        PROJECT_KEYS.clear()
+        IDENTITY_MAP.clear()
+
+        os.environ['APPLICATION_ID'] = "temp"
+        os.environ['USER_EMAIL'] = "test@example.com"
+        os.environ['SERVER_NAME'] = "example.com"
+        os.environ['SERVER_PORT'] = "80"
+
+        self.user = users.User("test@example.com")
+        self.project = Project(name="test", user=self.user)
+        self.project.put()
+        self.other = Project(name="other", user=self.user)
+        self.other.put()
+
+    def cache_project_pages(self, project):
+        "Cache the same set of pages the handlers do for a project"
+        depends = [project_dependency(project.slug)]
+        keys = [
+            "project_%s" % project.slug,
+            "project_%s_json" % project.slug,
+            "project_%s_rss_all" % project.slug,
+            "/%s/an-issue/" % project.slug,
+            "/%s/an-issue.json" % project.slug,
+        ]
+        for key in keys:
+            set_cache(key, "value", depends=depends)
+        return keys
+
+class CacheInvalidationTest(ModelTest):
+    def test_issue_put_drops_every_project_page(self):
+        keys = self.cache_project_pages(self.project)
+        Issue(name="an issue", project=self.project).put()
+        for key in keys:
+            self.assertEqual(get_cache(key, depends=[project_dependency(self.project.slug)]), None)
+
+    def test_issue_put_leaves_other_projects_cached(self):
+        keys = self.cache_project_pages(self.other)
+        Issue(name="an issue", project=self.project).put()
+        for key in keys:
+            self.assertEqual(get_cache(key, depends=[project_dependency(self.other.slug)]), "value")
+
+    def test_project_put_drops_project_lists(self):
+        set_cache("projects", "value", depends=[PROJECTS_DEPENDENCY])
+        self.project.put()
+        self.assertEqual(get_cache("projects", depends=[PROJECTS_DEPENDENCY]), None)
+
+class IssueCountTest(ModelTest):
+    def counts(self):
+        project = Project.get(self.project.key())
+        return project.open_count, project.closed_count
+
+    def test_new_issue_is_counted(self):
+        Issue(name="an issue", project=self.project).put()
+        Issue(name="fixed issue", project=self.project, fixed=True).put()
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_fixing_issue_moves_count(self):
+        issue = Issue(name="an issue", project=self.project)
+        issue.put()
+        issue = Issue.get(issue.key())
+        issue.fixed = True
+        issue.put()
+        self.assertEqual(self.counts(), (0, 1))
+        issue.fixed = False
+        issue.put()
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_saving_unchanged_issue_keeps_count(self):
+        issue = Issue(name="an issue", project=self.project)
+        issue.put()
+        Issue.get(issue.key()).put()
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_deleting_issue_removes_count(self):
+        issue = Issue(name="an issue", project=self.project)
+        issue.put()
+        Issue.get(issue.key()).delete()
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_repair_counts(self):
+        Issue(name="an issue", project=self.project).put()
+        Issue(name="fixed issue", project=self.project, fixed=True).put()
+        project = Project.get(self.project.key())
+        project.open_count = 10
+        project.closed_count = 10
+        # saved directly, as put keeps the counts it finds stored
+        db.put(project)
+        project.repair_counts()
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_saving_project_keeps_newer_counts(self):
+        project = Project.get(self.project.key())
+        Issue(name="an issue", project=self.project).put()
+        project.description = "changed"
+        project.put()
+        self.assertEqual(self.counts(), (1, 0))
+        self.assertEqual(Project.get(self.project.key()).description, "changed")
+
+    def test_editing_issue_doesnt_save_project(self):
+        issue = Issue(name="an issue", project=self.project)
+        issue.put()
+        modified = Project.get(self.project.key()).modified_date
+        issue = Issue.get(issue.key())
+        issue.description = "changed"
+        issue.put()
+        self.assertEqual(Project.get(self.project.key()).modified_date, modified)
+
+class IdentifierTest(ModelTest):
+    def run_threads(self, count, target):
+        "Run target in count threads at once, collecting any errors"
+        errors = []
+        def run(number):
+            try:
+                target(number)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_identifiers_follow_on_within_a_block(self):
+        first = Issue(name="first issue", project=self.project)
+        first.put()
+        second = Issue(name="second issue", project=self.project)
+        second.put()
+        self.assertEqual((first.identifier, second.identifier), (1, 2))
+
+    def test_counter_moves_on_a_block_at_a_time(self):
+        Issue(name="an issue", project=self.project).put()
+        counter = Counter.get_by_key_name("counter/%s" % self.project.name)
+        self.assertEqual(counter.count, IDENTIFIERS.block_size)
+
+    def test_parallel_puts_get_unique_identifiers(self):
+        def put(number):
+            for i in range(5):
+                Issue(name="issue %s %s" % (number, i), project=self.project).put()
+        self.run_threads(10, put)
+        identifiers = [issue.identifier for issue in Issue.all().filter('project =', self.project)]
+        self.assertEqual(len(identifiers), 50)
+        self.assertEqual(len(set(identifiers)), 50)
+
+    def test_recreated_project_doesnt_reuse_a_block(self):
+        allocator = IdentifierAllocator(10)
+        self.assertEqual(allocator.allocate(self.project), 1)
+        db.delete(self.project)
+        recreated = Project(name="test", user=self.user)
+        recreated.put()
+        self.assertEqual(recreated.key(), self.project.key())
+        self.assertEqual(allocator.allocate(recreated), 11)
+
+    def test_projects_are_locked_separately(self):
+        allocator = IdentifierAllocator(10)
+        lock = allocator.lock_for((str(self.project.key()), self.project.created_date))
+        lock.acquire()
+        try:
+            # would wait forever if every project shared one lock
+            self.assertEqual(allocator.allocate(self.other), 1)
+        finally:
+            lock.release()
+
+    def test_separate_instances_get_unique_identifiers(self):
+        # each allocator stands in for a different instance sharing the datastore
+        allocators = [IdentifierAllocator(3) for i in range(4)]
+        allocated = []
+        def allocate(number):
+            allocator = allocators[number % len(allocators)]
+            for i in range(10):
+                allocated.append(allocator.allocate(self.project))
+        self.run_threads(8, allocate)
+        self.assertEqual(len(allocated), 80)
+        self.assertEqual(len(set(allocated)), 80)
+
+class ProjectKeyTest(ModelTest):
+    def legacy_project(self, name):
+        "Save a project the way they were before key names were used"
+        project = Project(name=name, user=self.user, key_name=None)
+        project.put()
+        return project
+
+    def test_new_project_has_slug_key_name(self):
+        self.assertEqual(self.project.key().name(), "project/test")
+
+    def test_duplicate_project_isnt_saved(self):
+        Issue(name="an issue", project=self.project).put()
+        second = Project(name="Test", user=users.User("other@example.com"))
+        self.assertRaises(DuplicateProject, second.put)
+        project = Project.get(self.project.key())
+        self.assertEqual(project.name, "test")
+        self.assertEqual(project.user, self.user)
+        self.assertEqual(project.open_count, 1)
+
+    def test_get_project_by_slug(self):
+        self.assertEqual(get_project("test").key(), self.project.key())
+        self.assertEqual(get_project("missing"), None)
+
+    def test_legacy_project_key_is_remembered(self):
+        project = self.legacy_project("legacy")
+        self.assertEqual(project.key().name(), None)
+        self.assertEqual(get_project("legacy").key(), project.key())
+        self.assertEqual(PROJECT_KEYS["legacy"], str(project.key()))
+
+    def test_migrate_moves_issues_and_counter(self):
+        project = self.legacy_project("legacy")
+        issue = Issue(name="an issue", project=project)
+        issue.put()
+        get_project("legacy")
+
+        migrated = Project.get(project.key()).migrate()
+        self.assertEqual(migrated.key().name(), "project/legacy")
+        self.assertEqual(migrated.legacy_key, str(project.key()))
+        self.assertEqual(Project.get(project.key()), None)
+        self.assertEqual(Issue.get(issue.key()).project.key(), migrated.key())
+        counter = Counter.get_by_key_name("counter/legacy")
+        self.assertEqual(counter.project.key(), migrated.key())
+
+        # the remembered key is out of date but the project is still found
+        self.assertEqual(get_project("legacy").key(), migrated.key())
+        self.assertFalse("legacy" in PROJECT_KEYS)
+
+class IssueKeyTest(ModelTest):
+    def legacy_issue(self, name):
+        "Save an issue the way they were before key names were used"
+        issue = Issue(name=name, project=self.project, key_name=None)
+        issue.put()
+        # remove the mapping, as the old put didn't save one
+        db.delete(IssueIdentifier.key_for(self.project.slug, issue.identifier))
+        return issue
+
+    def test_new_issue_has_url_key_name(self):
+        issue = Issue(name="An Issue", project=self.project)
+        issue.put()
+        self.assertEqual(issue.key().name(), "issue/test/an-issue")
+        self.assertEqual(get_issue("test", "an-issue").key(), issue.key())
+        self.assertEqual(get_issue("test", "missing"), None)
+
+    def test_duplicate_issue_isnt_saved(self):
+        first = Issue(name="An Issue", project=self.project)
+        first.put()
+        second = Issue(name="An Issue", description="again", project=self.project)
+        self.assertRaises(DuplicateIssue, second.put)
+        self.assertEqual(Issue.get(first.key()).description, None)
+        self.assertEqual(Project.get(self.project.key()).open_count, 1)
+        self.assertEqual(IssueSummary.all().count(), 1)
+        self.assertEqual(IssueIdentifier.all().count(), 1)
+
+    def test_get_issues_by_identifier(self):
+        first = Issue(name="first", project=self.project)
+        first.put()
+        second = Issue(name="second", project=self.project)
+        second.put()
+        issues = get_issues_by_identifier(self.project, [first.identifier, second.identifier, 99])
+        self.assertEqual(issues[first.identifier].key(), first.key())
+        self.assertEqual(issues[second.identifier].key(), second.key())
+        self.assertFalse(99 in issues)
+
+    def test_delete_removes_identifier(self):
+        issue = Issue(name="an issue", project=self.project)
+        issue.put()
+        Issue.get(issue.key()).delete()
+        self.assertEqual(db.get(IssueIdentifier.key_for(self.project.slug, issue.identifier)), None)
+
+    def test_legacy_issue_found_until_backfilled(self):
+        issue = self.legacy_issue("legacy issue")
+        self.assertEqual(get_issue("test", "legacy-issue").key(), issue.key())
+        self.assertEqual(get_issues_by_identifier(self.project, [issue.identifier])[issue.identifier].key(), issue.key())
+
+        moved = Issue.get(issue.key()).backfill()
+        self.assertEqual(moved.key().name(), "issue/test/legacy-issue")
+        self.assertEqual(Issue.get(issue.key()), None)
+        self.assertEqual(get_issue("test", "legacy-issue").key(), moved.key())
+        mapping = db.get(IssueIdentifier.key_for(self.project.slug, issue.identifier))
+        self.assertEqual(mapping.issue.key(), moved.key())
+
+class PrefetchTest(ModelTest):
+    def test_prefetch_shares_one_project(self):
+        for name in ("first", "second", "third"):
+            Issue(name=name, project=self.project).put()
+        Issue(name="elsewhere", project=self.other).put()
+        issues = prefetch_references(Issue.all().fetch(10))
+        self.assertEqual(len(issues), 4)
+        projects = [issue.project for issue in issues if issue.project.key() == self.project.key()]
+        self.assertEqual(len(projects), 3)
+        self.assertTrue(projects[0] is projects[1] is projects[2])
+
+    def test_prefetch_only_named_references(self):
+        Issue(name="an issue", project=self.project).put()
+        prefetch_references(Issue.all().fetch(10), "missing")
+        self.assertFalse(IDENTITY_MAP.get(self.project.key()))
+
+    def test_entities_fetched_once_per_request(self):
+        self.assertTrue(get_project("test") is get_project("test"))
+        Issue(name="an issue", project=self.project).put()
+        self.assertTrue(get_issue("test", "an-issue").project is get_project("test"))
+        project = get_project("test")
+        IDENTITY_MAP.clear()
+        self.assertFalse(get_project("test") is project)
+
+class IssueSummaryTest(ModelTest):
+    def summary(self, issue):
+        return IssueSummary.get(IssueSummary.key_for(issue.key()))
+
+    def test_put_saves_summary(self):
+        issue = Issue(name="an issue", project=self.project,
+            description="A *long* description " + "of the problem " * 20)
+        issue.put()
+        summary = self.summary(issue)
+        self.assertEqual(summary.name, "an issue")
+        self.assertEqual(summary.identifier, issue.identifier)
+        self.assertEqual(summary.internal_url, issue.internal_url)
+        self.assertEqual(summary.project.key(), self.project.key())
+        self.assertTrue(summary.excerpt.startswith("A long description"))
+        self.assertTrue(len(summary.excerpt) <= 200)
+
+    def test_summary_follows_changes(self):
+        issue = Issue(name="an issue", project=self.project)
+        issue.put()
+        issue.fixed = True
+        issue.put()
+        self.assertTrue(self.summary(issue).fixed)
+        Issue.get(issue.key()).delete()
+        self.assertEqual(self.summary(issue), None)
+
+    def test_backfill_saves_summary(self):
+        issue = Issue(name="legacy issue", project=self.project, key_name=None)
+        issue.put()
+        db.delete(IssueSummary.key_for(issue.key()))
+        moved = Issue.get(issue.key()).backfill()
+        self.assertEqual(self.summary(issue), None)
+        self.assertEqual(self.summary(moved).name, "legacy issue")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+
+from google.appengine.api import apiproxy_stub_map, datastore_file_stub
+from google.appengine.ext import db
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+from rpc import Result, fetch_async, count_async, wait
+
+class Item(db.Model):
+    name = db.StringProperty()
+    even = db.BooleanProperty()
+
+class RpcTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+        os.environ['APPLICATION_ID'] = "temp"
+
+        self.keys = db.put([Item(name="item %s" % i, even=(i % 2 == 0)) for i in range(20)])
+
+    def names(self, items):
+        return [item and item.name for item in items]
+
+    def test_fetch_matches_sequential(self):
+        query = Item.all().filter('even =', True).order('name')
+        self.assertEqual(self.names(fetch_async(query, 5).get_result()),
+            self.names(Item.all().filter('even =', True).order('name').fetch(5)))
+
+    def test_count_is_limited_only_when_asked(self):
+        self.assertEqual(count_async(Item.all(keys_only=True)).get_result(), 20)
+        self.assertEqual(count_async(Item.all(keys_only=True), 5).get_result(), 5)
+
+    def test_count_matches_sequential(self):
+        self.assertEqual(count_async(Item.all().filter('even =', False)).get_result(),
+            Item.all().filter('even =', False).count())
+
+    def test_wait_returns_results_in_order(self):
+        items, count = wait(
+            fetch_async(Item.all().order('name'), 3),
+            count_async(Item.all()),
+        )
+        self.assertEqual(self.names(items), ["item 0", "item 1", "item 10"])
+        self.assertEqual(count, 20)
+
+    def test_result_stands_in_for_a_call(self):
+        self.assertEqual(wait(Result(1), Result(2)), [1, 2])
+
+if __name__ == "__main__":
+    unittest.main()
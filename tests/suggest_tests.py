@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import unittest
+
+from google.appengine.api import mail_stub, apiproxy_stub_map, user_service_stub, datastore_file_stub, users
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import db
+try:
+    from google.appengine.api.taskqueue import taskqueue_stub
+except ImportError:
+    from google.appengine.api.labs.taskqueue import taskqueue_stub
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+import tasks
+from tasks import LocalQueue
+from lib import LOCAL_CACHE, IDENTITY_MAP
+from models import Project, Issue, IDENTIFIERS, PROJECT_KEYS
+from suggest import SuggestIndex, suggest, matches, build, parse
+import settings
+
+class MatchesTest(unittest.TestCase):
+
+    def test_matches(self):
+        tests = [
+            [['log'], ['login', 'page'], True],
+            [['log', 'pa'], ['login', 'page'], True],
+            [['page', 'log'], ['login', 'page'], True],
+            [['lag'], ['login', 'page'], False],
+            [['log', 'x'], ['login', 'page'], False],
+        ]
+        for typed, words, output in tests:
+            self.assertEqual(matches(typed, words), output)
+
+class SuggestTest(unittest.TestCase):
+    def setUp(self):
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('mail', mail_stub.MailServiceStub())
+        apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+        stub = datastore_file_stub.DatastoreFileStub('temp', '/dev/null', '/dev/null')
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+        apiproxy_stub_map.apiproxy.RegisterStub('taskqueue',
+            taskqueue_stub.TaskQueueServiceStub(root_path=app_path))
+        LOCAL_CACHE.clear()
+        tasks.INDEX_QUEUE = LocalQueue()
+        IDENTIFIERS.blocks.clear()
+        PROJECT_KEYS.clear()
+        IDENTITY_MAP.clear()
+
+        os.environ['APPLICATION_ID'] = "temp"
+        os.environ['USER_EMAIL'] = "test@example.com"
+        os.environ['SERVER_NAME'] = "example.com"
+        os.environ['SERVER_PORT'] = "80"
+
+        self.project = Project(name="test", user=users.User("test@example.com"))
+        self.project.put()
+
+    def names(self, text):
+        return [name for url, name in suggest("test", text)]
+
+    def test_index_built_from_existing_issues(self):
+        Issue(name="Login page crashes", project=self.project).put()
+        Issue(name="Logo is blurry", project=self.project).put()
+        self.assertEqual(SuggestIndex.all().count(), 0)
+        self.assertEqual(self.names("lo"), ["Logo is blurry", "Login page crashes"])
+        self.assertEqual(self.names("page log"), ["Login page crashes"])
+        self.assertEqual(self.names("nothing"), [])
+        self.assertEqual(SuggestIndex.all().count(), 1)
+
+    def test_index_follows_changes(self):
+        issue = Issue(name="Login page crashes", project=self.project)
+        issue.put()
+        self.assertEqual(self.names("crash"), ["Login page crashes"])
+        Issue(name="Crash on save", project=self.project).put()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(self.names("crash"), ["Crash on save", "Login page crashes"])
+        issue.name = "Login page hangs on save"
+        issue.put()
+        # changes wait for the queue
+        self.assertEqual(self.names("crash"), ["Crash on save", "Login page crashes"])
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(self.names("crash"), ["Crash on save"])
+        # renamed issues keep their place
+        self.assertEqual(self.names("save"), ["Crash on save", "Login page hangs on save"])
+        issue.delete()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(self.names("login"), [])
+
+    def test_index_is_limited_in_size(self):
+        max_bytes = settings.SUGGEST_MAX_BYTES
+        settings.SUGGEST_MAX_BYTES = 100
+        try:
+            for number in range(5):
+                Issue(name="crash %s" % number, project=self.project).put()
+            tasks.INDEX_QUEUE.run()
+            self.assertEqual(self.names("crash"), ["crash 4", "crash 3", "crash 2", "crash 1"])
+            Issue(name="crash 5", project=self.project).put()
+            tasks.INDEX_QUEUE.run()
+            self.assertEqual(self.names("crash"), ["crash 5", "crash 4", "crash 3", "crash 2"])
+            index = SuggestIndex.get(SuggestIndex.key_for("test"))
+            self.assertTrue(len(index.entries.encode('utf8')) <= 100)
+        finally:
+            settings.SUGGEST_MAX_BYTES = max_bytes
+
+    def test_existing_index_isnt_replaced(self):
+        Issue(name="Login page crashes", project=self.project).put()
+        self.assertEqual(self.names("crash"), ["Login page crashes"])
+        index = build("test")
+        self.assertEqual(parse(index.entries), [("/test/login-page-crashes/", "Login page crashes")])
+        self.assertEqual(SuggestIndex.all().count(), 1)
+
+    def test_recreated_project_starts_afresh(self):
+        Issue(name="Login page crashes", project=self.project).put()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(self.names("crash"), ["Login page crashes"])
+        self.project.delete()
+        IDENTITY_MAP.clear()
+        PROJECT_KEYS.clear()
+        project = Project(name="test", user=users.User("test@example.com"))
+        project.put()
+        # the old project's issues are still being removed
+        self.assertEqual(self.names("crash"), [])
+        Issue(name="Crash on save", project=project).put()
+        tasks.INDEX_QUEUE.run()
+        self.assertEqual(self.names("crash"), ["Crash on save"])
+
+    def test_number_of_suggestions_is_limited(self):
+        for number in range(settings.SUGGEST_LIMIT + 5):
+            Issue(name="crash %s" % number, project=self.project).put()
+        self.assertEqual(len(self.names("crash")), settings.SUGGEST_LIMIT)
+
+    def test_missing_project(self):
+        self.assertEqual(suggest("missing", "crash"), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+"""
+Compare the composite indexes in index.yaml with the queries the
+application actually runs, found by reading the source rather than by
+running it. Reports indexes nothing uses, queries with no index and an
+estimate of the index rows written when saving each kind.
+
+Usage: index_audit.py [--write] [--no-merge-join] [--words N] [source files]
+
+With --write a minimal index.yaml is written in place of the old one.
+Queries with only equality filters are answered by merging the built in
+indexes, unless --no-merge-join is given to give them an index of their own.
+"""
+
+import os
+import re
+import sys
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+
+SOURCES = ['main.py', 'models.py', 'admin.py', 'fulltext.py', 'suggest.py']
+
+# start of a query, either Model.all() or a reverse reference like issue_set
+QUERY_RE = re.compile(r'\b([A-Z]\w*)\.all\(|\b(\w+_set)\.')
+CALL_RE = re.compile(r'\s*\.\s*(\w+)\(')
+STRING_RE = re.compile(r'\s*[\'"]([^\'"]*)[\'"]')
+PROPERTY_RE = re.compile(r'^    (\w+) = db\.(\w+)\(', re.M)
+CLASS_RE = re.compile(r'^class (\w+)\(([\w.]+)\):', re.M)
+
+# reverse references used as queries, with the reference they filter on
+COLLECTIONS = {
+    'issue_set': ('Issue', 'project'),
+}
+
+# property types which aren't indexed
+UNINDEXED = ['TextProperty', 'BlobProperty']
+
+EQUALITY = ['=', '==', 'in', 'IN']
+
+# everything saved when a new issue is put, its search document
+# being written later by a queued task
+ISSUE_PUT = ['Issue', 'IssueSummary', 'IssueIdentifier', 'IndexPending', 'Project']
+
+# property types holding a list, with an index row for each value
+LISTS = ['StringListProperty', 'ListProperty']
+
+# typical number of values in each list property, with None for lists
+# of words whose size is given by --words. Lists not named here are
+# assumed to be small, like lists of members
+LIST_SIZES = {
+    ('SearchDocument', 'terms'): None,
+    ('Project', 'other_users'): 2,
+}
+LIST_SIZE = 3
+
+# kept at the end of the index file so the development server can
+# still add any indexes a new query needs
+AUTOGENERATED = """# AUTOGENERATED
+
+# This index.yaml is automatically updated whenever the dev_appserver
+# detects that a new type of query is run.  If you want to manage the
+# index.yaml file manually, remove the above marker line (the line
+# saying "# AUTOGENERATED").  If you want to manage some indexes
+# manually, move them above the marker line.  The index.yaml file is
+# automatically uploaded to the admin console when you next deploy
+# your application using appcfg.py.
+"""
+
+def closing_paren(text, start):
+    "Find the position just past the parenthesis closing the one before start"
+    depth = 1
+    position = start
+    while depth and position < len(text):
+        if text[position] == '(':
+            depth += 1
+        elif text[position] == ')':
+            depth -= 1
+        position += 1
+    return position
+
+def collect_queries(path):
+    """
+    Find each query in a source file, returning (kind, filters, orders,
+    line) where filters are (property, operator) pairs and orders are
+    (property, direction) pairs in the order they're applied
+    """
+    text = open(path).read()
+    queries = []
+    for match in QUERY_RE.finditer(text):
+        filters = []
+        orders = []
+        if match.group(1):
+            kind = match.group(1)
+            position = closing_paren(text, match.end())
+        else:
+            if not match.group(2) in COLLECTIONS:
+                continue
+            kind, reference = COLLECTIONS[match.group(2)]
+            filters.append((reference, '='))
+            position = match.end() - 1
+        # follow the chain of calls made on the query
+        while True:
+            call = CALL_RE.match(text, position)
+            if not call:
+                break
+            end = closing_paren(text, call.end())
+            argument = STRING_RE.match(text, call.end())
+            if argument and call.group(1) == 'filter':
+                parts = argument.group(1).split()
+                if len(parts) == 1:
+                    parts.append('=')
+                filters.append((parts[0], parts[1]))
+            elif argument and call.group(1) == 'order':
+                name = argument.group(1)
+                if name.startswith('-'):
+                    orders.append((name[1:], 'desc'))
+                else:
+                    orders.append((name, 'asc'))
+            position = end
+        line = text.count('\n', 0, match.start()) + 1
+        queries.append((kind, filters, orders, "%s:%s" % (os.path.basename(path), line)))
+    return queries
+
+def required_index(filters, orders, merge_join=True):
+    """
+    Work out the composite index a query needs as (equality properties,
+    ordered properties), or None if the built in indexes are enough
+    """
+    equality = []
+    inequality = None
+    for name, operator in filters:
+        if operator in EQUALITY:
+            if not name in equality:
+                equality.append(name)
+        else:
+            inequality = name
+    # sorting on a property with an equality filter makes no difference
+    orders = [(name, direction) for name, direction in orders if not name in equality]
+    if inequality and (not orders or orders[0][0] != inequality):
+        orders.insert(0, (inequality, 'asc'))
+    # results always come back in key order after everything else
+    if orders and orders[-1] == ('__key__', 'asc'):
+        orders = orders[:-1]
+
+    if not orders:
+        # equality filters alone are answered by merging the built in indexes
+        if merge_join or len(equality) < 2:
+            return None
+        return (tuple(equality[:-1]), ((equality[-1], 'asc'),))
+    if not equality and len(orders) == 1:
+        # a single property has built in indexes in both directions
+        return None
+    return (tuple(equality), tuple(orders))
+
+def read_indexes(path):
+    "Read the indexes from index.yaml as (kind, properties) pairs"
+    indexes = []
+    for line in open(path):
+        line = line.rstrip()
+        if line.startswith('- kind:'):
+            indexes.append((line.split(':', 1)[1].strip(), []))
+        elif line.strip().startswith('- name:') and indexes:
+            indexes[-1][1].append([line.split(':', 1)[1].strip(), 'asc'])
+        elif line.strip().startswith('direction:') and indexes:
+            indexes[-1][1][-1][1] = line.split(':', 1)[1].strip()
+    return [(kind, tuple([tuple(prop) for prop in properties])) for kind, properties in indexes]
+
+def satisfies(index, kind, needed):
+    "Check whether an existing index can answer a query needing an index"
+    index_kind, properties = index
+    equality, orders = needed
+    if index_kind != kind or len(properties) != len(equality) + len(orders):
+        return False
+    prefix = properties[:len(equality)]
+    # equality properties can come in any order and in either direction
+    if sorted([name for name, direction in prefix]) != sorted(equality):
+        return False
+    return properties[len(equality):] == orders
+
+def model_properties(path):
+    "Read the indexed properties of each model class in a source file"
+    text = open(path).read()
+    classes = list(CLASS_RE.finditer(text))
+    models = {}
+    for position, match in enumerate(classes):
+        if position + 1 < len(classes):
+            end = classes[position + 1].start()
+        else:
+            end = len(text)
+        body = text[match.end():end]
+        properties = PROPERTY_RE.findall(body)
+        models[match.group(1)] = {
+            'base': match.group(2),
+            'properties': [name for name, kind in properties if not kind in UNINDEXED],
+            'lists': [name for name, kind in properties if kind in LISTS],
+        }
+    return models
+
+def index_rows(kind, model, indexes, words):
+    """
+    Estimate the index rows written when saving a new entity of a kind.
+    Each indexed property has an ascending and descending row, there is
+    a row for the kind and one for each composite index
+    """
+    rows = 1 + 2 * len(model['properties'])
+    rows += len([index for index in indexes if index[0] == kind])
+    # list properties have a row for each value, in both directions
+    for name in model['lists']:
+        size = LIST_SIZES.get((kind, name), LIST_SIZE)
+        if size is None:
+            size = words
+        rows += 2 * (size - 1)
+    if model['base'] == 'search.SearchableModel':
+        rows += 2 * words
+    return rows
+
+def format_index(kind, properties, comment):
+    "Format an index the way index.yaml lays them out"
+    lines = ["# %s" % comment, "- kind: %s" % kind, "  properties:"]
+    for name, direction in properties:
+        lines.append("  - name: %s" % name)
+        if direction == 'desc':
+            lines.append("    direction: desc")
+    return "\n".join(lines)
+
+def main(args):
+    write = '--write' in args
+    merge_join = not '--no-merge-join' in args
+    words = 50
+    if '--words' in args:
+        position = args.index('--words')
+        words = int(args[position + 1])
+        args = args[:position] + args[position + 2:]
+    sources = [arg for arg in args if not arg.startswith('--')] or SOURCES
+
+    queries = []
+    for source in sources:
+        queries.extend(collect_queries(os.path.join(app_path, source)))
+    index_path = os.path.normpath(os.path.join(app_path, 'index.yaml'))
+    existing = read_indexes(index_path)
+
+    # each different index needed, with where it's used
+    needs = []
+    places = {}
+    print "Queries"
+    for kind, filters, orders, where in queries:
+        needed = required_index(filters, orders, merge_join)
+        described = ", ".join(["%s %s" % pair for pair in filters] +
+            ["order %s %s" % pair for pair in orders]) or "all"
+        if needed is None:
+            print "  %-14s %-50s built in (%s)" % (kind, described, where)
+            continue
+        print "  %-14s %-50s composite (%s)" % (kind, described, where)
+        if not (kind, needed) in needs:
+            needs.append((kind, needed))
+        places.setdefault((kind, needed), []).append(where)
+
+    # the smallest set of indexes covering every query, keeping
+    # the existing definition where there is one
+    minimal = []
+    print
+    print "Missing indexes"
+    for kind, needed in needs:
+        matches = [index for index in existing if satisfies(index, kind, needed)]
+        if matches:
+            index = matches[0]
+        else:
+            index = (kind, tuple([(name, 'asc') for name in needed[0]]) + needed[1])
+            print "  %s %s used by %s" % (kind, list(index[1]), ", ".join(places[(kind, needed)]))
+        if not index in minimal:
+            minimal.append(index)
+            places[index] = []
+        places[index].extend(places[(kind, needed)])
+
+    print
+    print "Unused indexes"
+    for index in existing:
+        if not index in minimal:
+            print "  %s %s" % (index[0], list(index[1]))
+
+    print
+    print "Estimated index rows written per new entity, with %d words of searchable text" % words
+    models = model_properties(os.path.join(app_path, 'models.py'))
+    models.update(model_properties(os.path.join(app_path, 'fulltext.py')))
+    totals = [0, 0]
+    for kind in sorted(models.keys()):
+        if not models[kind]['base'].split('.')[0] in ('db', 'search'):
+            continue
+        rows = (index_rows(kind, models[kind], existing, words),
+            index_rows(kind, models[kind], minimal, words))
+        print "  %-16s now %4d  minimal %4d" % ((kind,) + rows)
+        if kind in ISSUE_PUT:
+            totals = [totals[0] + rows[0], totals[1] + rows[1]]
+    print "  %-16s now %4d  minimal %4d  (%s)" % ("Issue.put", totals[0], totals[1],
+        ", ".join(ISSUE_PUT))
+
+    if write:
+        output = open(index_path, 'w')
+        output.write("indexes:\n\n")
+        for index in minimal:
+            # just the files, as line numbers soon go out of date
+            files = []
+            for where in places[index]:
+                name = where.split(':')[0]
+                if not name in files:
+                    files.append(name)
+            output.write(format_index(index[0], index[1],
+                "used by %s" % ", ".join(files)) + "\n\n")
+        output.write(AUTOGENERATED)
+        output.close()
+        print
+        print "Wrote %d indexes to %s" % (len(minimal), index_path)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Time searches across projects against a synthetic set of issues held in
+the local datastore stub, reporting the median, 95th percentile and
+slowest times for searches with cold and warm caches.
+
+Usage: search_benchmark.py [--issues N] [--projects N] [--visible N] [--searches N]
+
+The defaults build 100,000 issues spread over 200 projects and search
+as a user who can see 20 of them, then as one who can see them all,
+which is searched with a single query rather than one per project.
+The stub is much slower to write to
+and quicker to query than the real datastore, so the numbers are for
+comparing one version of the search code with another rather than a
+prediction of production latency.
+"""
+
+import os
+import sys
+import time
+import random
+
+# insert application path
+app_path = os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), '../'
+)
+sys.path.insert(0, app_path)
+
+# assuming appengine isn't already on your path you'll need to set this
+if os.environ.get('APPENGINE_PATH'):
+    sys.path.append(os.environ['APPENGINE_PATH'])
+
+from google.appengine.api import apiproxy_stub_map, datastore_file_stub, users, memcache
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import db
+
+from lib import LOCAL_CACHE
+from models import Project, Issue, IssueSummary
+from fulltext import document_for, search_visible
+
+# words issues are made from, the first ones used far more than the rest
+WORDS = """
+error page crash login user project issue feed search broken slow email
+button link date password upload image firefox safari chrome javascript
+style layout admin settings delete create update title description rss
+json webhook commit identifier cache timeout server request response font
+colour sidebar header footer table list count mobile unicode encoding
+""".split()
+
+BATCH_SIZE = 500
+
+def option(args, name, default):
+    "Read a numeric option from the command line"
+    if name in args:
+        return int(args[args.index(name) + 1])
+    return default
+
+def setup_stubs():
+    "Use an in memory datastore and memcache"
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = datastore_file_stub.DatastoreFileStub('benchmark', '/dev/null', '/dev/null')
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    os.environ['APPLICATION_ID'] = "benchmark"
+
+def words(count):
+    "Pick words with a skewed distribution, like real issue text"
+    return " ".join([WORDS[int(random.paretovariate(1.2)) % len(WORDS)] for i in range(count)])
+
+def build(issue_count, project_count):
+    """
+    Save projects and their issues' summaries and search documents
+    directly, in bulk, as saving each issue normally would take hours
+    """
+    owner = users.User("owner@example.com")
+    projects = [Project(name="project %s" % number, slug="project-%s" % number, user=owner)
+        for number in range(project_count)]
+    db.put(projects)
+    entities = []
+    for number in range(issue_count):
+        project = projects[number % project_count]
+        slug = "issue-%s" % number
+        issue = Issue(
+            key_name=Issue.key_template % {'project': project.slug, 'slug': slug},
+            name=words(random.randint(2, 6)),
+            description=words(random.randint(5, 60)),
+            project=project,
+            identifier=number + 1,
+            internal_url="/%s/%s/" % (project.slug, slug),
+        )
+        # the issue itself isn't read by searches so isn't saved
+        entities.append(IssueSummary.for_issue(issue))
+        entities.append(document_for(issue))
+        if len(entities) >= BATCH_SIZE:
+            db.put(entities)
+            entities = []
+    if entities:
+        db.put(entities)
+    return projects
+
+def percentile(times, fraction):
+    "The time below which this fraction of the times fall"
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+def report(name, times):
+    print "  %-6s median %7.1fms  p95 %7.1fms  max %7.1fms" % (name,
+        percentile(times, 0.5) * 1000, percentile(times, 0.95) * 1000, max(times) * 1000)
+
+def run(projects, visible_count, searches):
+    "Time each search of a random sample of the projects with cold and warm caches"
+    visible = [project.key() for project in random.sample(projects, visible_count)]
+    cold = []
+    warm = []
+    for text in searches:
+        memcache.flush_all()
+        LOCAL_CACHE.clear()
+        for times in (cold, warm):
+            started = time.time()
+            # cached just as the search handler caches it
+            results = search_visible(visible, text)
+            db.get([IssueSummary.key_for(db.Key(issue)) for score, issue in results[:20]])
+            times.append(time.time() - started)
+
+    print "%d searches of %d projects" % (len(searches), visible_count)
+    report("cold", cold)
+    report("warm", warm)
+
+def main(args):
+    issue_count = option(args, '--issues', 100000)
+    project_count = option(args, '--projects', 200)
+    visible_count = option(args, '--visible', 20)
+    search_count = option(args, '--searches', 200)
+
+    setup_stubs()
+    random.seed(1)
+    started = time.time()
+    projects = build(issue_count, project_count)
+    print "Built %d issues in %d projects in %.0fs" % (issue_count, project_count,
+        time.time() - started)
+
+    searches = [words(random.randint(1, 3)) for i in range(search_count)]
+    for count in sorted(set([min(visible_count, project_count), project_count])):
+        run(projects, count, searches)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])